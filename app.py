@@ -1,35 +1,177 @@
-from flask import Flask, request, render_template, session, redirect, url_for, jsonify
-from openai import OpenAI
+from flask import Flask, request, render_template, session, redirect, url_for, jsonify, g, has_app_context, has_request_context, Response, stream_with_context
+from openai import AsyncOpenAI, APITimeoutError, RateLimitError, InternalServerError
+import re
+import math
+import random
+import bisect
+import base64
+import binascii
+import hashlib
+import datetime
 import time
 import uuid
+import io
+import csv
+import tempfile
+import select
+import json
+import threading
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import collections
+from contextlib import contextmanager, asynccontextmanager
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.errors
 from werkzeug.security import generate_password_hash, check_password_hash
+from markupsafe import escape
 import os
 import logging
+import logging.handlers
+import queue
+import atexit
 import asyncio
-from asgiref.wsgi import WsgiToAsgi
+import sys
 
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY", "zhenya-secret-key")
 
-# Настройка логирования
-logging.basicConfig(level=logging.DEBUG)
+# Логирование настраивает create_app (или команды migrate/warmup), а не импорт модуля.
+# LOG_MODE=production: JSON-строки, запись через очередь в отдельном потоке, выборка
+# DEBUG/INFO с долей LOG_SAMPLE_RATE (WARNING и выше пишутся всегда).
+LOG_MODE = os.getenv("LOG_MODE", "development")
+PRODUCTION_LOGGING = LOG_MODE in ("production", "prod")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO" if PRODUCTION_LOGGING else "DEBUG").upper()
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1"))
+# Шумные библиотеки в production-режиме пишут только предупреждения
+NOISY_LOGGERS = ("httpx", "httpx2", "httpcore", "httpcore2", "openai", "asyncio")
 logger = logging.getLogger(__name__)
 
-# Считываем API-ключ
-api_key = os.getenv("OPENROUTER_API_KEY")
-if not api_key:
-    logger.error("OPENROUTER_API_KEY не найден в переменных окружения! Приложение не может запуститься.")
-    raise ValueError("OPENROUTER_API_KEY не задан в переменных окружения")
-logger.info(f"OPENROUTER_API_KEY успешно считан: {api_key[:10]}... (первые 10 символов)")
+# Миграции при старте приложения; при нескольких воркерах лучше AUTO_MIGRATE=0 и отдельный
+# python app.py migrate перед выкладкой
+AUTO_MIGRATE = os.getenv("AUTO_MIGRATE", "1") == "1"
 
 # API настройки для OpenRouter
-client = OpenAI(
-    base_url="https://openrouter.ai/api/v1",
-    api_key=api_key
-)
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "120"))
+TITLE_TIMEOUT = float(os.getenv("TITLE_TIMEOUT", "10"))
+
+# Планировщик запросов к модели: общий лимит одновременных запросов (стрим ответа занимает
+# слот до конца генерации), глубина очереди и сколько в ней можно ждать — дольше запрос
+# получает 429 или событие error; лимит пользователя (токены в секунду и размер пачки,
+# корзины хранятся для LLM_USER_BUCKETS последних пользователей) и повторы при 429/5xx
+# от апстрима. Лимиты действуют в пределах одного воркера.
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "64"))
+LLM_QUEUE_MAX = int(os.getenv("LLM_QUEUE_MAX", "128"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "15"))
+LLM_USER_BUCKETS = int(os.getenv("LLM_USER_BUCKETS", "10000"))
+LLM_USER_RATE = float(os.getenv("LLM_USER_RATE", "0.5"))
+LLM_USER_BURST = float(os.getenv("LLM_USER_BURST", "5"))
+LLM_RETRIES = int(os.getenv("LLM_RETRIES", "2"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "1"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "10"))
+
+# Пул моделей: LLM_MODELS="модель=цена,модель2=цена2" (цена — относительная, по ней
+# выбирается модель для названий). Здоровье модели считается по запросам за последние
+# LLM_HEALTH_TTL секунд; если первый токен не пришёл за LLM_HEDGE_AFTER секунд,
+# параллельно запрашивается следующая модель (0 — не хеджировать).
+LLM_HEDGE_AFTER = float(os.getenv("LLM_HEDGE_AFTER", "4"))
+LLM_HEALTH_WINDOW = int(os.getenv("LLM_HEALTH_WINDOW", "50"))
+LLM_HEALTH_TTL = float(os.getenv("LLM_HEALTH_TTL", "300"))
+LLM_UNHEALTHY_ERROR_RATE = float(os.getenv("LLM_UNHEALTHY_ERROR_RATE", "0.5"))
+
+# Контекст для модели: бюджет в токенах и сколько последних сообщений читать из БД
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+CONTEXT_TAIL_LIMIT = int(os.getenv("CONTEXT_TAIL_LIMIT", "40"))
+SUMMARY_MIN_BATCH = int(os.getenv("SUMMARY_MIN_BATCH", "4"))
+SUMMARY_MAX_BATCH = int(os.getenv("SUMMARY_MAX_BATCH", "50"))
+SUMMARY_TIMEOUT = float(os.getenv("SUMMARY_TIMEOUT", "30"))
+
+# Размеры страниц истории чата и списка чатов
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "30"))
+CHATS_PAGE_SIZE = int(os.getenv("CHATS_PAGE_SIZE", "30"))
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "20"))
+# Если у запроса не меньше SEARCH_MAX_CANDIDATES совпадений (частые слова в длинной истории),
+# ранжируются только совпадения среди последних SEARCH_SCAN_WINDOW сообщений пользователя,
+# не больше SEARCH_MAX_CANDIDATES; ответ тогда помечается truncated
+SEARCH_MAX_CANDIDATES = int(os.getenv("SEARCH_MAX_CANDIDATES", "2000"))
+SEARCH_SCAN_WINDOW = int(os.getenv("SEARCH_SCAN_WINDOW", "10000"))
+
+# Экспорт и импорт истории: строк за одну выборку серверного курсора, размер куска ответа,
+# число одновременных выгрузок на процесс (каждая держит соединение из пула и поток WSGI)
+# и предельный размер загружаемого файла
+EXPORT_FETCH_SIZE = int(os.getenv("EXPORT_FETCH_SIZE", "1000"))
+EXPORT_CHUNK_BYTES = int(os.getenv("EXPORT_CHUNK_BYTES", str(64 * 1024)))
+EXPORT_MAX_CONCURRENT = int(os.getenv("EXPORT_MAX_CONCURRENT", "2"))
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", str(100 * 1024 * 1024)))
+
+# Аутентификация: хеширование паролей в отдельном пуле из AUTH_WORKERS потоков, не больше
+# AUTH_QUEUE_MAX входов/регистраций одновременно, остальные ждут очереди до AUTH_QUEUE_TIMEOUT
+# секунд; попытки входа ограничены на имя пользователя (LOGIN_BURST подряд, затем LOGIN_RATE
+# в секунду). Счётчики попыток хранятся не больше чем для LOGIN_BUCKETS имён; счётчик, который
+# ещё ограничивает вход, не вытесняется — при переполнении новые имена ждут, пока место
+# освободится. Стиль пользователя кэшируется в сессии.
+AUTH_WORKERS = int(os.getenv("AUTH_WORKERS", "2"))
+AUTH_QUEUE_MAX = int(os.getenv("AUTH_QUEUE_MAX", "8"))
+AUTH_QUEUE_TIMEOUT = float(os.getenv("AUTH_QUEUE_TIMEOUT", "10"))
+LOGIN_RATE = float(os.getenv("LOGIN_RATE", str(1 / 30)))
+LOGIN_BURST = float(os.getenv("LOGIN_BURST", "5"))
+LOGIN_BUCKETS = int(os.getenv("LOGIN_BUCKETS", "50000"))
+USER_STYLE_TTL = float(os.getenv("USER_STYLE_TTL", "60"))
+
+# Кэш списка чатов на стороне сервера (вместо хранения в cookie-сессии)
+CHAT_LIST_CACHE_SIZE = int(os.getenv("CHAT_LIST_CACHE_SIZE", "10000"))
+CHAT_LIST_CACHE_TTL = float(os.getenv("CHAT_LIST_CACHE_TTL", "60"))
+CHAT_LIST_CACHE_REDIS_URL = os.getenv("CHAT_LIST_CACHE_REDIS_URL")
+
+# Кэш ответов модели: для ответов включается списком стилей, для названий — TITLE_CACHE.
+# Ключ учитывает модель, системный промпт стиля, контекст и сам вопрос (без учёта регистра
+# и лишних пробелов). Ответы кэшируются, только пока весь контекст — не больше
+# RESPONSE_CACHE_HISTORY сообщений и без сводки, то есть для одинаковых начал разговора.
+RESPONSE_CACHE_STYLES = {style.strip() for style in os.getenv("RESPONSE_CACHE_STYLES", "").split(",") if style.strip()}
+TITLE_CACHE = os.getenv("TITLE_CACHE", "1") == "1"
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "5000"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+RESPONSE_CACHE_HISTORY = int(os.getenv("RESPONSE_CACHE_HISTORY", "2"))
+RESPONSE_CACHE_PURGE_INTERVAL = float(os.getenv("RESPONSE_CACHE_PURGE_INTERVAL", "3600"))
+
+_api_key = None
+
+def get_api_key():
+    global _api_key
+    if _api_key is None:
+        api_key = os.getenv("OPENROUTER_API_KEY")
+        if not api_key:
+            logger.error("OPENROUTER_API_KEY не найден в переменных окружения! Приложение не может запуститься.")
+            raise ValueError("OPENROUTER_API_KEY не задан в переменных окружения")
+        logger.info("OPENROUTER_API_KEY успешно считан: %s... (первые 10 символов)", api_key[:10])
+        _api_key = api_key
+    return _api_key
+
+# Один асинхронный клиент (и его пул HTTP-соединений) на event loop
+_async_clients = {}
+
+def get_async_client():
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = AsyncOpenAI(
+            base_url=OPENROUTER_BASE_URL,
+            api_key=get_api_key(),
+            timeout=LLM_TIMEOUT,
+            max_retries=0  # повторы делает create_with_retries с учётом Retry-After
+        )
+    return client
+
+async def close_async_client():
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
 
 IO_MODEL = "google/gemma-2-9b-it:free"
+LLM_MODELS = os.getenv("LLM_MODELS", IO_MODEL)
 
 STYLES = {
     "sassy": {
@@ -66,242 +208,2145 @@ STYLES = {
     }
 }
 
+# Активные ходы диалога этого процесса: request_id -> владелец, event loop и событие отмены
 active_requests = {}
+_active_requests_lock = threading.Lock()
+CANCEL_CHANNEL = "chat_cancel"
 
-def get_db_connection():
+# Настройки пула соединений с БД
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_HEALTHCHECK_INTERVAL = float(os.getenv("DB_POOL_HEALTHCHECK_INTERVAL", "30"))
+
+# Потоки для обычных (синхронных) маршрутов Flask под ASGI-сервером
+WSGI_THREADS = int(os.getenv("WSGI_THREADS", "16"))
+# Тело запроса больше этого размера ASGI-мост держит во временном файле, а не в памяти
+REQUEST_BODY_SPOOL_BYTES = int(os.getenv("REQUEST_BODY_SPOOL_BYTES", str(1024 * 1024)))
+
+# Трассировка хода диалога: при TRACE_REQUESTS=1 в лог пишутся интервалы запросов
+# к POST /, которые длились дольше TRACE_SLOW_SECONDS
+TRACE_REQUESTS = os.getenv("TRACE_REQUESTS", "0") == "1"
+TRACE_SLOW_SECONDS = float(os.getenv("TRACE_SLOW_SECONDS", "2"))
+
+# Метрики в текстовом формате Prometheus, отдаются на /metrics. Значения живут
+# в памяти процесса: при нескольких воркерах каждый считает своё.
+metrics_registry = []
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_metric_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in pairs) + "}"
+
+    def _snapshot(self):
+        with self._lock:
+            return sorted(self._values.items())
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{self._labels(key)} {format_metric_value(value)}"]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in self._snapshot():
+            lines.extend(self._render_value(key, value))
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    # function — значение, вычисляемое при отдаче метрик: число или {значения меток: число}
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def _snapshot(self):
+        if self.function is None:
+            return super()._snapshot()
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return sorted(values.items())
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=()):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _snapshot(self):
+        with self._lock:
+            return sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items())
+
+    def _render_value(self, key, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f"{self.name}_bucket{self._labels(key, [('le', format_metric_value(float(bound)))])} {cumulative}")
+        lines.append(f"{self.name}_bucket{self._labels(key, [('le', '+Inf')])} {count}")
+        lines.append(f"{self.name}_sum{self._labels(key)} {format_metric_value(total)}")
+        lines.append(f"{self.name}_count{self._labels(key)} {count}")
+        return lines
+
+def render_metrics():
+    return "\n".join(line for metric in metrics_registry for line in metric.render()) + "\n"
+
+LLM_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+DB_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+HTTP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+HTTP_REQUEST_SECONDS = Histogram("zhenyagpt_http_request_duration_seconds", "Время обработки HTTP-запроса, включая стрим ответа",
+                                 ("method", "route", "status"), HTTP_BUCKETS)
+HTTP_REQUESTS_IN_FLIGHT = Gauge("zhenyagpt_http_requests_in_flight", "HTTP-запросы в обработке")
+LLM_REQUEST_SECONDS = Histogram("zhenyagpt_llm_request_duration_seconds", "Длительность запроса к модели до конца ответа",
+                                ("model", "purpose", "style"), LLM_BUCKETS)
+LLM_TTFT_SECONDS = Histogram("zhenyagpt_llm_time_to_first_token_seconds", "Время до первого токена ответа модели",
+                             ("model", "style"), LLM_BUCKETS)
+LLM_REQUESTS_IN_FLIGHT = Gauge("zhenyagpt_llm_requests_in_flight", "Запросы к модели в процессе", ("purpose",))
+LLM_ERRORS = Counter("zhenyagpt_llm_errors_total", "Ошибки запросов к модели", ("model", "purpose", "error"))
+LLM_TIMEOUTS = Counter("zhenyagpt_llm_timeouts_total", "Запросы к модели, прерванные по таймауту", ("model", "purpose"))
+DB_HELPER_SECONDS = Histogram("zhenyagpt_db_helper_duration_seconds", "Время вызова хелпера БД, включая ожидание соединения",
+                              ("helper",), DB_BUCKETS)
+DB_QUERIES = Counter("zhenyagpt_db_queries_total", "Выполненные SQL-запросы по хелперам", ("helper",))
+LLM_QUEUE_WAIT_SECONDS = Histogram("zhenyagpt_llm_queue_wait_seconds", "Ожидание слота в очереди к модели",
+                                   ("purpose",), LLM_BUCKETS)
+LLM_REJECTED = Counter("zhenyagpt_llm_rejected_total", "Запросы, отклонённые планировщиком с 429", ("reason",))
+LLM_RETRIES_TOTAL = Counter("zhenyagpt_llm_retries_total", "Повторы запросов к модели после 429/5xx", ("purpose", "status"))
+CHAT_TURNS_IN_FLIGHT = Gauge("zhenyagpt_chat_turns_in_flight", "Ходы диалога в процессе генерации",
+                             function=lambda: len(active_requests))
+
+# Имя хелпера БД, внутри которого выполняется запрос (для zhenyagpt_db_queries_total)
+_current_db_helper = contextvars.ContextVar("current_db_helper", default="other")
+
+def db_helper(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = _current_db_helper.set(func.__name__)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            DB_HELPER_SECONDS.observe(time.perf_counter() - start, helper=func.__name__)
+            _current_db_helper.reset(token)
+    return wrapper
+
+def record_llm_call(model, purpose, style, duration, error=None, latency=None):
+    # latency — время до первого токена для стримов; по нему и ошибкам считается здоровье модели
+    if isinstance(error, UpstreamBusy):
+        return
+    LLM_REQUEST_SECONDS.observe(duration, model=model, purpose=purpose, style=style)
+    if isinstance(error, (asyncio.TimeoutError, APITimeoutError)):
+        LLM_TIMEOUTS.inc(model=model, purpose=purpose)
+    elif isinstance(error, Exception):
+        LLM_ERRORS.inc(model=model, purpose=purpose, error=type(error).__name__)
+    health = model_pool.get(model)
+    if health is not None:
+        # Отменённый запрос (проигравший хедж, стоп) — не ошибка, но его задержка показательна
+        health.record(latency if latency is not None else duration, not isinstance(error, Exception))
+
+async def observe_llm_call(purpose, model, create, timeout, key=None, style=""):
+    # Неструминговый запрос к модели через планировщик; timeout включает ожидание
+    # в очереди. create — функция без аргументов, возвращающая корутину запроса.
+    async def call():
+        async with get_llm_scheduler().slot(key, purpose):
+            return await create_with_retries(create, purpose)
+
+    start = time.perf_counter()
+    error = None
+    LLM_REQUESTS_IN_FLIGHT.inc(purpose=purpose)
     try:
-        conn = psycopg2.connect(os.getenv("DATABASE_URL"))
+        return await asyncio.wait_for(call(), timeout)
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        LLM_REQUESTS_IN_FLIGHT.dec(purpose=purpose)
+        record_llm_call(model, purpose, style, time.perf_counter() - start, error)
+
+class RequestTrace:
+    # Интервалы одного запроса: (имя, начало от старта запроса, длительность)
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.started = time.perf_counter()
+        self.spans = []
+
+    def add(self, name, started):
+        self.spans.append((name, started - self.started, time.perf_counter() - started))
+
+    @contextmanager
+    def span(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, started)
+
+    def finish(self):
+        total = time.perf_counter() - self.started
+        if TRACE_REQUESTS and total >= TRACE_SLOW_SECONDS and logger.isEnabledFor(logging.INFO):
+            spans = "; ".join(f"{name} +{offset:.3f} {duration:.3f}" for name, offset, duration in self.spans)
+            logger.info("Трасса запроса %s: всего %.3f с; %s", self.request_id, total, spans)
+
+class PoolTimeout(psycopg2.OperationalError):
+    pass
+
+class PooledConnection(psycopg2.extensions.connection):
+    on_query = None
+
+class CountingCursor(psycopg2.extensions.cursor):
+    # Считает выполненные запросы для статистики пула (запросов к БД на HTTP-запрос)
+    def execute(self, query, vars=None):
+        DB_QUERIES.inc(helper=_current_db_helper.get())
+        if self.connection.on_query is not None:
+            self.connection.on_query()
+        return super().execute(query, vars)
+
+class ConnectionPool:
+    # Ограниченный пул соединений: не больше maxconn открытых соединений,
+    # при исчерпании ждём освобождения до timeout секунд.
+    def __init__(self, dsn, minconn, maxconn, timeout, healthcheck_interval):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = max(maxconn, 1)
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+        self._idle = collections.deque()
+        self._size = 0
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._timeouts = 0
+        self._discarded = 0
+        self._queries = 0
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, connection_factory=PooledConnection, cursor_factory=CountingCursor)
+        conn.on_query = self._count_query
         return conn
+
+    def _count_query(self):
+        with self._cond:
+            self._queries += 1
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.healthcheck_interval:
+            return True
+        try:
+            with conn.cursor() as c:
+                c.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def warm(self):
+        conns = [self.getconn() for _ in range(min(self.minconn, self.maxconn))]
+        for conn in conns:
+            self.putconn(conn)
+
+    def getconn(self):
+        wait_started = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    conn, last_used = None, None
+                    break
+                if wait_started is None:
+                    wait_started = time.monotonic()
+                    self._waits += 1
+                remaining = self.timeout - (time.monotonic() - wait_started)
+                if remaining <= 0:
+                    self._timeouts += 1
+                    self._wait_time += time.monotonic() - wait_started
+                    raise PoolTimeout(f"Нет свободных соединений в пуле за {self.timeout} секунд")
+                self._cond.wait(remaining)
+            if wait_started is not None:
+                self._wait_time += time.monotonic() - wait_started
+            self._in_use += 1
+            self._checkouts += 1
+
+        try:
+            if conn is not None and not self._is_healthy(conn, last_used):
+                logger.warning("Соединение из пула не прошло проверку, переподключаемся")
+                self._close(conn)
+                with self._cond:
+                    self._discarded += 1
+                conn = None
+            if conn is None:
+                conn = self._connect()
+            return conn
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def putconn(self, conn, discard=False):
+        if not conn.closed and not discard:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        with self._cond:
+            self._in_use -= 1
+            if conn.closed or discard:
+                self._size -= 1
+                self._discarded += 1
+                self._close(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._size -= 1
+                self._close(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "min": self.minconn,
+                "max": self.maxconn,
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "wait_time_total": round(self._wait_time, 6),
+                "timeouts": self._timeouts,
+                "discarded": self._discarded,
+                "queries": self._queries,
+            }
+
+db_pool = None
+_db_pool_lock = threading.Lock()
+
+DB_POOL_CONNECTIONS = Gauge("zhenyagpt_db_pool_connections", "Соединения пула БД по состоянию", ("state",),
+                            function=lambda: {} if db_pool is None else {
+                                ("in_use",): db_pool.stats()["in_use"], ("idle",): db_pool.stats()["idle"]})
+
+def get_db_pool():
+    global db_pool
+    if db_pool is None:
+        with _db_pool_lock:
+            if db_pool is None:
+                db_pool = ConnectionPool(os.getenv("DATABASE_URL"), DB_POOL_MIN, DB_POOL_MAX,
+                                         DB_POOL_TIMEOUT, DB_POOL_HEALTHCHECK_INTERVAL)
+    return db_pool
+
+# Внутри run_db контекст запроса скопирован в поток пула, и параллельные вызовы одного хода
+# делили бы g._db_conn. Там каждый вызов берёт своё соединение и сразу возвращает его.
+_in_run_db = contextvars.ContextVar("in_run_db", default=False)
+
+def uses_request_connection():
+    return has_app_context() and not _in_run_db.get()
+
+def get_db_connection():
+    # В рамках запроса используем одно соединение, оно вернётся в пул в teardown
+    try:
+        if uses_request_connection():
+            conn = g.get('_db_conn')
+            if conn is not None and conn.closed:
+                get_db_pool().putconn(conn)
+                conn = None
+            if conn is None:
+                conn = g._db_conn = get_db_pool().getconn()
+            return conn
+        return get_db_pool().getconn()
     except psycopg2.Error as e:
         logger.error(f"Ошибка подключения к БД: {str(e)}")
         raise
 
-def init_db():
+def release_db_connection(conn):
+    if uses_request_connection() and g.get('_db_conn') is conn:
+        return
+    get_db_pool().putconn(conn)
+
+@contextmanager
+def db_cursor():
+    conn = get_db_connection()
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        
-        c.execute('''CREATE TABLE IF NOT EXISTS users (
-                        id SERIAL PRIMARY KEY,
-                        username TEXT UNIQUE NOT NULL,
-                        password TEXT NOT NULL
-                     )''')
-        
-        c.execute('''CREATE TABLE IF NOT EXISTS chats (
-                        id TEXT PRIMARY KEY,
-                        user_id INTEGER,
-                        title TEXT NOT NULL DEFAULT 'Без названия',
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                     )''')
-        
-        c.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'chats'")
-        columns = [row[0] for row in c.fetchall()]
-        if 'last_active' not in columns:
-            c.execute('ALTER TABLE chats ADD COLUMN last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP')
-        
-        c.execute('''CREATE TABLE IF NOT EXISTS messages (
-                        id SERIAL PRIMARY KEY,
-                        chat_id TEXT,
-                        role TEXT NOT NULL,
-                        content TEXT NOT NULL,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (chat_id) REFERENCES chats (id)
-                     )''')
-        
-        c.execute('''CREATE TABLE IF NOT EXISTS user_settings (
-                        user_id INTEGER PRIMARY KEY,
-                        style TEXT NOT NULL DEFAULT 'sassy',
-                        FOREIGN KEY (user_id) REFERENCES users (id)
-                     )''')
-        
+        with conn.cursor() as c:
+            yield c
         conn.commit()
-        conn.close()
+    except Exception:
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+        raise
+    finally:
+        release_db_connection(conn)
+
+def release_request_db_connection():
+    conn = g.pop('_db_conn', None)
+    if conn is not None:
+        get_db_pool().putconn(conn)
+
+@app.teardown_appcontext
+def return_db_connection(exc):
+    release_request_db_connection()
+
+# Синхронные вызовы БД из асинхронного кода выполняются в отдельном пуле потоков,
+# чтобы не блокировать event loop
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_MAX, thread_name_prefix="db")
+
+def _run_db_call(func, *args):
+    # Выполняется в собственной копии контекста: флаг не виден ни запросу, ни другим вызовам
+    _in_run_db.set(True)
+    return func(*args)
+
+async def run_db(func, *args):
+    loop = asyncio.get_running_loop()
+    call = functools.partial(contextvars.copy_context().run, _run_db_call, func, *args)
+    return await loop.run_in_executor(db_executor, call)
+
+# Фоновый event loop для WSGI-режима (wsgi.py, app.run), где нет своего цикла событий
+_bridge_loop = None
+_bridge_loop_lock = threading.Lock()
+
+def get_bridge_loop():
+    global _bridge_loop
+    if _bridge_loop is None:
+        with _bridge_loop_lock:
+            if _bridge_loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="async-bridge", daemon=True).start()
+                _bridge_loop = loop
+    return _bridge_loop
+
+def run_async(coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_bridge_loop()).result()
+
+async def _anext(agen):
+    return await agen.__anext__()
+
+def iterate_async(agen):
+    try:
+        while True:
+            try:
+                yield run_async(_anext(agen))
+            except StopAsyncIteration:
+                return
+    finally:
+        run_async(agen.aclose())
+
+# Версионированные миграции схемы: (версия, описание, список SQL-выражений).
+# Каждая миграция применяется в отдельной транзакции и записывается в schema_migrations.
+MIGRATIONS = [
+    (1, "initial schema", [
+        '''CREATE TABLE IF NOT EXISTS users (
+               id SERIAL PRIMARY KEY,
+               username TEXT UNIQUE NOT NULL,
+               password TEXT NOT NULL
+           )''',
+        '''CREATE TABLE IF NOT EXISTS chats (
+               id TEXT PRIMARY KEY,
+               user_id INTEGER,
+               title TEXT NOT NULL DEFAULT 'Без названия',
+               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+           )''',
+        '''CREATE TABLE IF NOT EXISTS messages (
+               id SERIAL PRIMARY KEY,
+               chat_id TEXT,
+               role TEXT NOT NULL,
+               content TEXT NOT NULL,
+               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+               FOREIGN KEY (chat_id) REFERENCES chats (id)
+           )''',
+        '''CREATE TABLE IF NOT EXISTS user_settings (
+               user_id INTEGER PRIMARY KEY,
+               style TEXT NOT NULL DEFAULT 'sassy',
+               FOREIGN KEY (user_id) REFERENCES users (id)
+           )''',
+    ]),
+    (2, "chats.last_active", [
+        "ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP",
+    ]),
+    # id в конце индексов — для пагинации по курсору (метка времени, id)
+    (3, "indexes for chat list and history", [
+        "CREATE INDEX IF NOT EXISTS idx_messages_chat_created_id ON messages (chat_id, created_at, id)",
+        "CREATE INDEX IF NOT EXISTS idx_chats_user_last_active_id ON chats (user_id, last_active DESC, id DESC)",
+    ]),
+    (4, "cascade delete of messages", [
+        "ALTER TABLE messages DROP CONSTRAINT IF EXISTS messages_chat_id_fkey",
+        "ALTER TABLE messages ADD CONSTRAINT messages_chat_id_fkey FOREIGN KEY (chat_id) REFERENCES chats (id) ON DELETE CASCADE",
+    ]),
+    (5, "running chat summaries", [
+        '''CREATE TABLE IF NOT EXISTS chat_summaries (
+               chat_id TEXT PRIMARY KEY REFERENCES chats (id) ON DELETE CASCADE,
+               summary TEXT NOT NULL,
+               last_message_id INTEGER NOT NULL,
+               updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+           )''',
+    ]),
+    (6, "model that served each message", [
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS model TEXT",
+    ]),
+    # UNLOGGED: кэш не пишет WAL и переживает штатный перезапуск, но очищается после сбоя
+    (7, "persistent response cache", [
+        '''CREATE UNLOGGED TABLE IF NOT EXISTS response_cache (
+               key TEXT PRIMARY KEY,
+               kind TEXT NOT NULL,
+               model TEXT,
+               response TEXT NOT NULL,
+               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+               expires_at TIMESTAMP NOT NULL
+           )''',
+        "CREATE INDEX IF NOT EXISTS idx_response_cache_expires ON response_cache (expires_at)",
+    ]),
+    # Полнотекстовый поиск по сообщениям пользователя: владелец чата дублируется в messages,
+    # чтобы фильтр по пользователю и GIN-индекс работали без соединения с chats
+    (8, "full-text search over messages", [
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS user_id INTEGER",
+        "UPDATE messages m SET user_id = c.user_id FROM chats c WHERE c.id = m.chat_id AND m.user_id IS NULL",
+        '''ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+               to_tsvector('russian', content) || to_tsvector('english', content)
+           ) STORED''',
+        "CREATE INDEX IF NOT EXISTS idx_messages_search ON messages USING GIN (search_vector)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages (user_id, id)",
+    ]),
+]
+
+# Ключ advisory-блокировки, чтобы несколько воркеров не мигрировали одновременно
+MIGRATIONS_LOCK_ID = 7311001
+
+def migrate():
+    pool = get_db_pool()
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as c:
+            c.execute("SELECT pg_advisory_lock(%s)", (MIGRATIONS_LOCK_ID,))
+            try:
+                c.execute('''CREATE TABLE IF NOT EXISTS schema_migrations (
+                                version INTEGER PRIMARY KEY,
+                                name TEXT NOT NULL,
+                                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                             )''')
+                conn.commit()
+                c.execute("SELECT version FROM schema_migrations")
+                applied = {row[0] for row in c.fetchall()}
+                for version, name, statements in MIGRATIONS:
+                    if version in applied:
+                        continue
+                    try:
+                        for statement in statements:
+                            c.execute(statement)
+                        c.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+                        conn.commit()
+                    except Exception:
+                        conn.rollback()
+                        raise
+                    logger.info("Применена миграция %s: %s", version, name)
+            finally:
+                c.execute("SELECT pg_advisory_unlock(%s)", (MIGRATIONS_LOCK_ID,))
+                conn.commit()
         logger.info("База данных успешно инициализирована")
     except Exception as e:
-        logger.error(f"Ошибка при инициализации БД: {str(e)}")
+        logger.error(f"Ошибка при миграции БД: {str(e)}")
         raise
+    finally:
+        pool.putconn(conn)
+
+def pending_migrations():
+    try:
+        with db_cursor() as c:
+            c.execute("SELECT version FROM schema_migrations")
+            applied = {row[0] for row in c.fetchall()}
+    except psycopg2.errors.UndefinedTable:
+        applied = set()
+    return [version for version, _, _ in MIGRATIONS if version not in applied]
+
+def warm_up():
+    # Соединения пула открываются до первого запроса; без AUTO_MIGRATE проверяем, что схема актуальна
+    get_db_pool().warm()
+    pending = pending_migrations()
+    if pending:
+        logger.warning("Не применены миграции %s: выполните python app.py migrate", pending)
+    return pending
+
+@app.cli.command("migrate")
+def migrate_command():
+    configure_logging()
+    migrate()
+
+@app.cli.command("warmup")
+def warmup_command():
+    configure_logging()
+    if warm_up():
+        sys.exit(1)
+
+class LRUCache:
+    # Потокобезопасный LRU-кэш в памяти процесса с TTL на запись
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+class RedisCache:
+    # Общий для всех воркеров кэш; нужен пакет redis (не входит в requirements.txt)
+    def __init__(self, url, ttl):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.client.get(key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value):
+        self.client.set(key, json.dumps(value, ensure_ascii=False), ex=max(int(self.ttl), 1))
+
+    def delete(self, key):
+        self.client.delete(key)
+
+def create_chat_list_cache():
+    if CHAT_LIST_CACHE_REDIS_URL:
+        try:
+            return RedisCache(CHAT_LIST_CACHE_REDIS_URL, CHAT_LIST_CACHE_TTL)
+        except ImportError:
+            logger.error("CHAT_LIST_CACHE_REDIS_URL задан, но пакет redis не установлен; используем кэш в памяти")
+    return LRUCache(CHAT_LIST_CACHE_SIZE, CHAT_LIST_CACHE_TTL)
+
+chat_list_cache = create_chat_list_cache()
 
-init_db()
+def invalidate_chat_list(user_id):
+    if user_id is None:
+        return
+    try:
+        chat_list_cache.delete(f"chats:{user_id}")
+    except Exception as e:
+        logger.error(f"Ошибка сброса кэша списка чатов: {str(e)}")
+
+RESPONSE_CACHE_REQUESTS = Counter("zhenyagpt_response_cache_requests_total", "Обращения к кэшу ответов модели",
+                                  ("kind", "result"))
+
+def normalize_cache_text(text):
+    return " ".join((text or "").lower().split())
+
+def response_cache_key(kind, model, system_prompt, history, user_input):
+    history = history[-RESPONSE_CACHE_HISTORY:] if RESPONSE_CACHE_HISTORY > 0 else []
+    payload = json.dumps([kind, model, system_prompt,
+                          [[m["role"], normalize_cache_text(m["content"])] for m in history],
+                          normalize_cache_text(user_input)], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def cacheable_reply_history(style, context, api_messages):
+    # История для ключа кэша ответа или None, если ответ кэшировать нельзя: ключ должен покрывать
+    # всё, что видела модель, иначе другой пользователь с теми же последними репликами получил бы
+    # ответ, построенный на чужой истории
+    history = api_messages[1:-1]
+    if style not in RESPONSE_CACHE_STYLES or context["summary"] or len(history) > RESPONSE_CACHE_HISTORY:
+        return None
+    return history
+
+@db_helper
+def get_cached_responses(keys):
+    try:
+        with db_cursor() as c:
+            c.execute("SELECT key, model, response FROM response_cache WHERE key = ANY(%s) AND expires_at > CURRENT_TIMESTAMP",
+                      (list(keys),))
+            return {row[0]: {"model": row[1], "response": row[2]} for row in c.fetchall()}
+    except Exception as e:
+        logger.error(f"Ошибка чтения кэша ответов: {str(e)}")
+        return {}
+
+@db_helper
+def save_cached_response(key, kind, model, response, ttl):
+    try:
+        with db_cursor() as c:
+            c.execute("INSERT INTO response_cache (key, kind, model, response, expires_at) "
+                      "VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP + %s * INTERVAL '1 second') "
+                      "ON CONFLICT (key) DO UPDATE SET model = EXCLUDED.model, response = EXCLUDED.response, "
+                      "created_at = CURRENT_TIMESTAMP, expires_at = EXCLUDED.expires_at",
+                      (key, kind, model, response, ttl))
+    except Exception as e:
+        logger.error(f"Ошибка записи кэша ответов: {str(e)}")
 
+@db_helper
+def purge_cached_responses():
+    try:
+        with db_cursor() as c:
+            c.execute("DELETE FROM response_cache WHERE expires_at <= CURRENT_TIMESTAMP")
+    except Exception as e:
+        logger.error(f"Ошибка очистки кэша ответов: {str(e)}")
+
+class ResponseCache:
+    # Двухуровневый кэш ответов: LRU в памяти процесса и общая для воркеров таблица
+    # response_cache. Значение — {"model", "response"}; методы синхронные, из async — через run_db.
+    def __init__(self, maxsize, ttl):
+        self.memory = LRUCache(maxsize, ttl)
+        self.ttl = ttl
+        self._last_purge = time.monotonic()
+
+    def get(self, kind, keys):
+        # keys — ключи для моделей в порядке предпочтения; возвращает первое найденное
+        for key in keys:
+            value = self.memory.get(key)
+            if value is not None:
+                RESPONSE_CACHE_REQUESTS.inc(kind=kind, result="memory")
+                return value
+        rows = get_cached_responses(keys)
+        for key in keys:
+            if key in rows:
+                self.memory.set(key, rows[key])
+                RESPONSE_CACHE_REQUESTS.inc(kind=kind, result="db")
+                return rows[key]
+        RESPONSE_CACHE_REQUESTS.inc(kind=kind, result="miss")
+        return None
+
+    def set(self, kind, key, model, response):
+        self.memory.set(key, {"model": model, "response": response})
+        save_cached_response(key, kind, model, response, self.ttl)
+        if time.monotonic() - self._last_purge > RESPONSE_CACHE_PURGE_INTERVAL:
+            self._last_purge = time.monotonic()
+            purge_cached_responses()
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+@db_helper
 def get_user_style(user_id):
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT style FROM user_settings WHERE user_id = %s", (user_id,))
-        result = c.fetchone()
-        conn.close()
+        with db_cursor() as c:
+            c.execute("SELECT style FROM user_settings WHERE user_id = %s", (user_id,))
+            result = c.fetchone()
         return result[0] if result else "sassy"
     except Exception as e:
         logger.error(f"Ошибка получения стиля пользователя: {str(e)}")
         return "sassy"
 
+@db_helper
 def set_user_style(user_id, style):
     if style not in STYLES:
         style = "sassy"
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("INSERT INTO user_settings (user_id, style) VALUES (%s, %s) ON CONFLICT (user_id) DO UPDATE SET style = %s", 
-                  (user_id, style, style))
-        conn.commit()
-        conn.close()
+        with db_cursor() as c:
+            c.execute("INSERT INTO user_settings (user_id, style) VALUES (%s, %s) ON CONFLICT (user_id) DO UPDATE SET style = %s", 
+                      (user_id, style, style))
+        if has_request_context():
+            remember_session_style(style)
     except Exception as e:
         logger.error(f"Ошибка установки стиля пользователя: {str(e)}")
 
-def get_all_chats(user_id):
+def remember_session_style(style):
+    session['style'] = [style, time.time() + USER_STYLE_TTL]
+
+def get_session_style(user_id):
+    # Стиль живёт в сессии USER_STYLE_TTL секунд: index() и ход диалога не ходят за ним в БД,
+    # а смена стиля с другого устройства подхватывается не позже чем через TTL
+    cached = session.get('style')
+    if cached and cached[0] in STYLES and cached[1] > time.time():
+        return cached[0]
+    style = get_user_style(user_id)
+    remember_session_style(style)
+    return style
+
+@db_helper
+def get_user_credentials(username):
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT id, title FROM chats WHERE user_id = %s ORDER BY last_active DESC", (user_id,))
-        chats = {row[0]: {"title": row[1], "history": []} for row in c.fetchall()}
-        conn.close()
-        return chats
+        with db_cursor() as c:
+            c.execute('''SELECT u.id, u.password, COALESCE(s.style, 'sassy')
+                         FROM users u LEFT JOIN user_settings s ON s.user_id = u.id
+                         WHERE u.username = %s''', (username,))
+            return c.fetchone()
     except Exception as e:
-        logger.error(f"Ошибка получения списка чатов: {str(e)}")
-        return {}
+        logger.error(f"Ошибка получения учётных данных: {str(e)}")
+        raise
 
+@db_helper
+def create_user(username, password_hash, style="sassy"):
+    # IntegrityError (имя занято) пробрасывается вызывающему
+    with db_cursor() as c:
+        c.execute("INSERT INTO users (username, password) VALUES (%s, %s) RETURNING id", (username, password_hash))
+        user_id = c.fetchone()[0]
+        c.execute("INSERT INTO user_settings (user_id, style) VALUES (%s, %s)", (user_id, style))
+    return user_id
+
+@db_helper
 def chat_exists(user_id, chat_id):
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT 1 FROM chats WHERE user_id = %s AND id = %s", (user_id, chat_id))
-        exists = c.fetchone() is not None
-        conn.close()
+        with db_cursor() as c:
+            c.execute("SELECT 1 FROM chats WHERE user_id = %s AND id = %s", (user_id, chat_id))
+            exists = c.fetchone() is not None
         return exists
     except Exception as e:
         logger.error(f"Ошибка проверки существования чата: {str(e)}")
         return False
 
-def get_chat_history(chat_id):
+# Курсор страницы — непрозрачная строка из (метка времени, id) последней отданной записи
+def encode_cursor(timestamp, row_id):
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{row_id}".encode()).decode()
+
+def decode_cursor(cursor):
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT role, content FROM messages WHERE chat_id = %s ORDER BY created_at ASC", (chat_id,))
-        history = [{"role": row[0], "content": row[1]} for row in c.fetchall()]
-        conn.close()
-        return history
+        timestamp, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.datetime.fromisoformat(timestamp), row_id
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        raise ValueError(f"Некорректный курсор: {cursor}")
+
+@db_helper
+def get_chats_page(user_id, before=None, limit=CHATS_PAGE_SIZE):
+    # Чаты по убыванию last_active; before — курсор из предыдущей страницы.
+    # Первая страница кэшируется и сбрасывается изменяющими чаты хелперами.
+    cache_key = f"chats:{user_id}" if before is None and limit == CHATS_PAGE_SIZE else None
+    if cache_key:
+        try:
+            cached = chat_list_cache.get(cache_key)
+            if cached is not None:
+                chats, next_cursor = cached
+                return chats, next_cursor
+        except Exception as e:
+            logger.error(f"Ошибка чтения кэша списка чатов: {str(e)}")
+    try:
+        with db_cursor() as c:
+            if before:
+                last_active, chat_id = decode_cursor(before)
+                c.execute("SELECT id, title, last_active FROM chats WHERE user_id = %s AND (last_active, id) < (%s, %s) "
+                          "ORDER BY last_active DESC, id DESC LIMIT %s", (user_id, last_active, chat_id, limit + 1))
+            else:
+                c.execute("SELECT id, title, last_active FROM chats WHERE user_id = %s "
+                          "ORDER BY last_active DESC, id DESC LIMIT %s", (user_id, limit + 1))
+            rows = c.fetchall()
+        next_cursor = encode_cursor(rows[limit - 1][2], rows[limit - 1][0]) if len(rows) > limit else None
+        chats = {row[0]: {"title": row[1]} for row in rows[:limit]}
+    except ValueError:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка получения страницы чатов: {str(e)}")
+        return {}, None
+    if cache_key:
+        try:
+            chat_list_cache.set(cache_key, (chats, next_cursor))
+        except Exception as e:
+            logger.error(f"Ошибка записи кэша списка чатов: {str(e)}")
+    return chats, next_cursor
+
+@db_helper
+def get_chat_page(chat_id, before=None, limit=HISTORY_PAGE_SIZE):
+    # Последние сообщения чата в хронологическом порядке; before — курсор для более старых
+    try:
+        with db_cursor() as c:
+            if before:
+                created_at, message_id = decode_cursor(before)
+                if not message_id.isdigit():
+                    raise ValueError(f"Некорректный курсор: {before}")
+                message_id = int(message_id)
+                c.execute("SELECT id, role, content, created_at FROM messages WHERE chat_id = %s AND (created_at, id) < (%s, %s) "
+                          "ORDER BY created_at DESC, id DESC LIMIT %s", (chat_id, created_at, message_id, limit + 1))
+            else:
+                c.execute("SELECT id, role, content, created_at FROM messages WHERE chat_id = %s "
+                          "ORDER BY created_at DESC, id DESC LIMIT %s", (chat_id, limit + 1))
+            rows = c.fetchall()
+        next_cursor = encode_cursor(rows[limit - 1][3], rows[limit - 1][0]) if len(rows) > limit else None
+        history = [{"role": row[1], "content": row[2]} for row in reversed(rows[:limit])]
+        return history, next_cursor
+    except ValueError:
+        raise
     except Exception as e:
         logger.error(f"Ошибка получения истории чата: {str(e)}")
+        return [], None
+
+# Границы совпадений в сниппете ts_headline: символы из области частного использования,
+# чтобы экранировать текст сообщения и только потом вставить <mark>
+SNIPPET_START, SNIPPET_STOP = "\ue000", "\ue001"
+
+def encode_search_cursor(rank, message_id):
+    return base64.urlsafe_b64encode(f"{rank!r}|{message_id}".encode()).decode()
+
+def decode_search_cursor(cursor):
+    try:
+        rank, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return float(rank), int(message_id)
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        raise ValueError(f"Некорректный курсор: {cursor}")
+
+def highlight_snippet(snippet):
+    return str(escape(snippet)).replace(SNIPPET_START, "<mark>").replace(SNIPPET_STOP, "</mark>")
+
+# Запрос websearch_to_tsquery подставляется в SQL константой, а не через CTE: так планировщик
+# видит частоту терминов и выбирает между GIN-индексом и обходом по id
+SEARCH_TSQUERY = "(websearch_to_tsquery('russian', %(query)s) || websearch_to_tsquery('english', %(query)s))"
+
+@db_helper
+def search_messages(user_id, query, cursor=None, limit=SEARCH_PAGE_SIZE):
+    # Сообщения пользователя по релевантности (русская и английская морфология);
+    # сниппеты строятся только для строк страницы. Курсор — (ранг, id) последнего результата.
+    # Возвращает (результаты, курсор, truncated): truncated — ранжированы только новые совпадения.
+    params = {"query": query, "user_id": user_id, "limit": limit + 1,
+              "window": SEARCH_SCAN_WINDOW, "candidates": SEARCH_MAX_CANDIDATES,
+              "options": f"StartSel={SNIPPET_START}, StopSel={SNIPPET_STOP}, MaxWords=35, MinWords=15, MaxFragments=2"}
+    after = ""
+    if cursor:
+        params["rank"], params["message_id"] = decode_search_cursor(cursor)
+        after = f"AND (ts_rank(m.search_vector, {SEARCH_TSQUERY}), m.id) < (%(rank)s::real, %(message_id)s)"
+    try:
+        with db_cursor() as c:
+            # Сначала дешёвая проверка, много ли совпадений: для редкого термина планировщик идёт
+            # по GIN-индексу, для частого — последовательно и останавливается на LIMIT. Редкие
+            # термины ранжируются по всей истории; для частых ранжирование всех совпадений
+            # слишком дорого, и берутся только совпадения среди последних сообщений.
+            scope = f"m.user_id = %(user_id)s AND m.search_vector @@ {SEARCH_TSQUERY}"
+            c.execute(f'''SELECT count(*) FROM (
+                             SELECT 1 FROM messages m WHERE {scope} LIMIT %(candidates)s
+                         ) s''', params)
+            truncated = c.fetchone()[0] >= SEARCH_MAX_CANDIDATES
+            if truncated:
+                c.execute(f'''SELECT w.id FROM (
+                                 SELECT id, search_vector FROM messages
+                                 WHERE user_id = %(user_id)s ORDER BY id DESC LIMIT %(window)s
+                             ) w
+                             WHERE w.search_vector @@ {SEARCH_TSQUERY}
+                             ORDER BY w.id DESC LIMIT %(candidates)s''', params)
+                params["ids"] = [row[0] for row in c.fetchall()]
+                scope = "m.id = ANY(%(ids)s)"
+            c.execute(f'''WITH hits AS (
+                             SELECT m.id, m.chat_id, m.role, m.content, m.created_at,
+                                    ts_rank(m.search_vector, {SEARCH_TSQUERY}) AS rank
+                             FROM messages m
+                             WHERE {scope} {after}
+                             ORDER BY rank DESC, m.id DESC
+                             LIMIT %(limit)s
+                         )
+                         SELECT h.id, h.chat_id, c.title, h.role, h.created_at, h.rank,
+                                ts_headline('russian', h.content, {SEARCH_TSQUERY}, %(options)s)
+                         FROM hits h JOIN chats c ON c.id = h.chat_id
+                         ORDER BY h.rank DESC, h.id DESC''', params)
+            rows = c.fetchall()
+        next_cursor = encode_search_cursor(rows[limit - 1][5], rows[limit - 1][0]) if len(rows) > limit else None
+        results = [{"message_id": row[0], "chat_id": row[1], "chat_title": row[2], "role": row[3],
+                    "created_at": row[4].isoformat(), "snippet": highlight_snippet(row[6])} for row in rows[:limit]]
+        return results, next_cursor, truncated
+    except ValueError:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка поиска по сообщениям: {str(e)}")
+        return [], None, False
+
+@db_helper
+def get_chat_context(chat_id):
+    # Сводка старой части чата и не больше CONTEXT_TAIL_LIMIT последних сообщений
+    try:
+        with db_cursor() as c:
+            c.execute("SELECT summary, last_message_id FROM chat_summaries WHERE chat_id = %s", (chat_id,))
+            row = c.fetchone()
+            summary, summary_upto = row if row else (None, 0)
+            c.execute("SELECT id, role, content FROM messages WHERE chat_id = %s AND id > %s "
+                      "ORDER BY created_at DESC, id DESC LIMIT %s", (chat_id, summary_upto, CONTEXT_TAIL_LIMIT))
+            messages = [{"id": row[0], "role": row[1], "content": row[2]} for row in reversed(c.fetchall())]
+        return {"summary": summary, "summary_upto": summary_upto, "messages": messages}
+    except Exception as e:
+        logger.error(f"Ошибка получения контекста чата: {str(e)}")
+        return {"summary": None, "summary_upto": 0, "messages": []}
+
+@db_helper
+def get_messages_to_summarize(chat_id, after_id, before_id):
+    try:
+        with db_cursor() as c:
+            c.execute("SELECT id, role, content FROM messages WHERE chat_id = %s AND id > %s AND id < %s "
+                      "ORDER BY id LIMIT %s", (chat_id, after_id, before_id, SUMMARY_MAX_BATCH))
+            return [{"id": row[0], "role": row[1], "content": row[2]} for row in c.fetchall()]
+    except Exception as e:
+        logger.error(f"Ошибка получения сообщений для сводки: {str(e)}")
         return []
 
+@db_helper
+def save_chat_summary(chat_id, summary, last_message_id):
+    try:
+        with db_cursor() as c:
+            c.execute("INSERT INTO chat_summaries (chat_id, summary, last_message_id) VALUES (%s, %s, %s) "
+                      "ON CONFLICT (chat_id) DO UPDATE SET summary = EXCLUDED.summary, "
+                      "last_message_id = EXCLUDED.last_message_id, updated_at = CURRENT_TIMESTAMP "
+                      "WHERE chat_summaries.last_message_id < EXCLUDED.last_message_id",
+                      (chat_id, summary, last_message_id))
+    except Exception as e:
+        logger.error(f"Ошибка сохранения сводки чата: {str(e)}")
+
+@db_helper
 def add_chat(chat_id, user_id, title="Без названия"):
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("INSERT INTO chats (id, user_id, title, last_active) VALUES (%s, %s, %s, CURRENT_TIMESTAMP) ON CONFLICT (id) DO NOTHING", 
-                  (chat_id, user_id, title))
-        conn.commit()
-        conn.close()
+        with db_cursor() as c:
+            c.execute("INSERT INTO chats (id, user_id, title, last_active) VALUES (%s, %s, %s, CURRENT_TIMESTAMP) ON CONFLICT (id) DO NOTHING", 
+                      (chat_id, user_id, title))
+        invalidate_chat_list(user_id)
     except Exception as e:
         logger.error(f"Ошибка добавления чата: {str(e)}")
 
+@db_helper
 def update_chat_title(chat_id, title):
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("UPDATE chats SET title = %s WHERE id = %s", (title[:30], chat_id))
-        conn.commit()
-        conn.close()
+        with db_cursor() as c:
+            c.execute("UPDATE chats SET title = %s WHERE id = %s RETURNING user_id", (title[:30], chat_id))
+            row = c.fetchone()
+        invalidate_chat_list(row[0] if row else None)
     except Exception as e:
         logger.error(f"Ошибка обновления названия чата: {str(e)}")
 
+@db_helper
 def update_chat_last_active(chat_id):
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("UPDATE chats SET last_active = CURRENT_TIMESTAMP WHERE id = %s", (chat_id,))
-        conn.commit()
-        conn.close()
+        with db_cursor() as c:
+            c.execute("UPDATE chats SET last_active = CURRENT_TIMESTAMP WHERE id = %s RETURNING user_id", (chat_id,))
+            row = c.fetchone()
+        invalidate_chat_list(row[0] if row else None)
     except Exception as e:
         logger.error(f"Ошибка обновления last_active чата: {str(e)}")
 
-def add_message(chat_id, role, content):
+@db_helper
+def save_chat_turn(user_id, chat_id, messages, title=None):
+    # Все записи хода диалога одной транзакцией: сообщения (role, content, model), last_active
+    # и название, если оно уже готово. Ошибка пробрасывается — ход не сохраняется частично.
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("INSERT INTO messages (chat_id, role, content) VALUES (%s, %s, %s)", (chat_id, role, content))
-        conn.commit()
-        conn.close()
-        update_chat_last_active(chat_id)
+        with db_cursor() as c:
+            psycopg2.extras.execute_values(c, "INSERT INTO messages (chat_id, user_id, role, content, model) VALUES %s",
+                                           [(chat_id, user_id, role, content, model) for role, content, model in messages])
+            c.execute("UPDATE chats SET last_active = CURRENT_TIMESTAMP, title = COALESCE(%s, title) WHERE id = %s RETURNING user_id",
+                      (title[:30] if title else None, chat_id))
+            row = c.fetchone()
+        invalidate_chat_list(row[0] if row else None)
     except Exception as e:
-        logger.error(f"Ошибка добавления сообщения: {str(e)}")
+        logger.error(f"Ошибка сохранения хода диалога: {str(e)}")
+        raise
 
+@db_helper
 def reset_chat(chat_id):
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("DELETE FROM messages WHERE chat_id = %s", (chat_id,))
-        c.execute("UPDATE chats SET title = 'Без названия', last_active = CURRENT_TIMESTAMP WHERE id = %s", (chat_id,))
-        conn.commit()
-        conn.close()
+        with db_cursor() as c:
+            c.execute("DELETE FROM messages WHERE chat_id = %s", (chat_id,))
+            c.execute("DELETE FROM chat_summaries WHERE chat_id = %s", (chat_id,))
+            c.execute("UPDATE chats SET title = 'Без названия', last_active = CURRENT_TIMESTAMP WHERE id = %s RETURNING user_id", (chat_id,))
+            row = c.fetchone()
+        invalidate_chat_list(row[0] if row else None)
     except Exception as e:
         logger.error(f"Ошибка сброса чата: {str(e)}")
 
+@db_helper
 def delete_chat(chat_id):
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("DELETE FROM messages WHERE chat_id = %s", (chat_id,))
-        c.execute("DELETE FROM chats WHERE id = %s", (chat_id,))
-        conn.commit()
-        conn.close()
+        with db_cursor() as c:
+            c.execute("DELETE FROM chats WHERE id = %s RETURNING user_id", (chat_id,))
+            row = c.fetchone()
+        invalidate_chat_list(row[0] if row else None)
     except Exception as e:
         logger.error(f"Ошибка удаления чата: {str(e)}")
 
-def get_response_from_api(chat_history, user_input, style):
-    start_time = time.time()
+# Экспорт истории: строки читаются серверным (именованным) курсором пачками по EXPORT_FETCH_SIZE,
+# так что память воркера не зависит от размера истории. Соединение берётся из пула на всё
+# время отдачи ответа и возвращается, когда клиент дочитал или отключился (ChatASGIApp.wsgi
+# закрывает тело ответа по http.disconnect). Одновременных выгрузок — не больше
+# EXPORT_MAX_CONCURRENT, чтобы медленные скачивания не заняли весь пул.
+export_slots = threading.BoundedSemaphore(max(EXPORT_MAX_CONCURRENT, 1))
+
+def iter_export_rows(user_id, chat_id=None):
+    conn = get_db_pool().getconn()
     try:
-        max_history_length = 3
-        truncated_history = chat_history[-max_history_length:] if len(chat_history) > max_history_length else chat_history
-        
-        messages = [STYLES[style]] + truncated_history + [{"role": "user", "content": user_input}]
-
-        completion = client.chat.completions.create(
-            model=IO_MODEL,
-            messages=messages,
-            max_tokens=1500,
-            temperature=0.9,
-            top_p=0.95
-        )
-        
-        response = completion.choices[0].message.content
-        end_time = time.time()
-        logger.debug(f"Время ответа API: {end_time - start_time:.2f} секунд")
-        return response
+        with conn.cursor(name=f"export_{uuid.uuid4().hex}") as c:
+            c.itersize = EXPORT_FETCH_SIZE
+            c.execute(f'''SELECT c.id, c.title, c.created_at, m.role, m.content, m.model, m.created_at
+                         FROM chats c LEFT JOIN messages m ON m.chat_id = c.id
+                         WHERE c.user_id = %(user_id)s {"AND c.id = %(chat_id)s" if chat_id else ""}
+                         ORDER BY c.created_at, c.id, m.created_at, m.id''',
+                      {"user_id": user_id, "chat_id": chat_id})
+            yield from c
     except Exception as e:
-        logger.error(f"Ошибка при запросе к API: {str(e)}")
-        return f"Ошибка: {str(e)}"
+        logger.error(f"Ошибка экспорта чатов: {str(e)}")
+        raise
+    finally:
+        get_db_pool().putconn(conn)
+
+def isoformat_or_none(value):
+    return value.isoformat() if value is not None else None
+
+def format_export_jsonl(rows):
+    # Строка {"type": "chat"} перед сообщениями каждого чата — тот же формат читает импорт
+    current_chat = None
+    for chat_id, title, chat_created_at, role, content, model, created_at in rows:
+        if chat_id != current_chat:
+            current_chat = chat_id
+            yield json.dumps({"type": "chat", "id": chat_id, "title": title,
+                              "created_at": isoformat_or_none(chat_created_at)}, ensure_ascii=False) + "\n"
+        if role is not None:
+            yield json.dumps({"type": "message", "chat_id": chat_id, "role": role, "content": content,
+                              "model": model, "created_at": isoformat_or_none(created_at)}, ensure_ascii=False) + "\n"
 
-async def generate_chat_title(user_input, request_id):
+EXPORT_ROLE_NAMES = {"user": "Пользователь", "assistant": "ZhenyaGPT"}
+
+def format_export_markdown(rows):
+    current_chat = None
+    for chat_id, title, chat_created_at, role, content, model, created_at in rows:
+        if chat_id != current_chat:
+            if current_chat is not None:
+                yield "---\n\n"
+            current_chat = chat_id
+            yield f"# {title}\n\n"
+        if role is not None:
+            stamp = f" · {created_at:%Y-%m-%d %H:%M}" if created_at is not None else ""
+            yield f"**{EXPORT_ROLE_NAMES.get(role, role)}**{stamp}\n\n{content}\n\n"
+
+# Формат экспорта -> (MIME-тип, расширение файла, форматтер строк)
+EXPORT_FORMATS = {
+    "jsonl": ("application/x-ndjson", "jsonl", format_export_jsonl),
+    "md": ("text/markdown; charset=utf-8", "md", format_export_markdown),
+}
+
+def export_chunks(user_id, chat_id, export_format):
+    # Мелкие строки склеиваются в куски по EXPORT_CHUNK_BYTES, чтобы не слать сообщение на каждую
+    formatter = EXPORT_FORMATS[export_format][2]
+    chunk, size = [], 0
+    for text in formatter(iter_export_rows(user_id, chat_id)):
+        data = text.encode("utf-8")
+        chunk.append(data)
+        size += len(data)
+        if size >= EXPORT_CHUNK_BYTES:
+            yield b"".join(chunk)
+            chunk, size = [], 0
+    if chunk:
+        yield b"".join(chunk)
+
+class CopyRows:
+    # Файлоподобный источник для COPY ... FROM STDIN (CSV): строки формируются по мере того,
+    # как psycopg2 читает данные, и не собираются в памяти целиком.
+    # QUOTE_NONNUMERIC кавычит и None (как ""), поэтому столбцы, где нужен NULL, перечисляются в FORCE_NULL.
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.count = 0
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer, quoting=csv.QUOTE_NONNUMERIC, lineterminator="\n")
+
+    def read(self, size=-1):
+        while size < 0 or self._buffer.tell() < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self._writer.writerow(row)
+            self.count += 1
+        data = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return data
+
+def parse_import_timestamp(value, number):
+    if value is None:
+        return datetime.datetime.now().isoformat()
     try:
-        if request_id not in active_requests:
-            logger.info(f"Запрос {request_id} был отменён")
-            return None
-        
-        completion = client.chat.completions.create(
-            model=IO_MODEL,
+        return datetime.datetime.fromisoformat(value).isoformat()
+    except (TypeError, ValueError):
+        raise ValueError(f"Строка {number}: некорректная дата {value!r}")
+
+def iter_import_records(stream):
+    # Построчное чтение JSONL-файла импорта; поток перематывается, чтобы его можно было пройти дважды
+    stream.seek(0)
+    lines = io.TextIOWrapper(stream, encoding="utf-8")
+    try:
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                raise ValueError(f"Строка {number}: некорректный JSON")
+            if not isinstance(record, dict):
+                raise ValueError(f"Строка {number}: ожидался объект")
+            yield number, record
+    except UnicodeDecodeError:
+        raise ValueError("Файл импорта должен быть в UTF-8")
+    finally:
+        lines.detach()
+
+def validate_import_message(record, number, chat_ids):
+    if not isinstance(record.get("chat_id"), str) or record["chat_id"] not in chat_ids:
+        raise ValueError(f"Строка {number}: сообщение ссылается на чат, который не объявлен выше")
+    if record.get("role") not in EXPORT_ROLE_NAMES:
+        raise ValueError(f"Строка {number}: неизвестная роль {record.get('role')!r}")
+    if not isinstance(record.get("content"), str):
+        raise ValueError(f"Строка {number}: нет текста сообщения")
+    # Postgres не хранит NUL в текстовых полях: COPY упал бы посреди импорта
+    if "\x00" in record["content"]:
+        raise ValueError(f"Строка {number}: текст сообщения содержит нулевой символ")
+    model = record.get("model")
+    return record["role"], record["content"], model if isinstance(model, str) and "\x00" not in model else None
+
+@db_helper
+def import_chats(user_id, stream):
+    # Импорт из JSONL в формате экспорта (строка чата идёт раньше его сообщений). Первый проход
+    # проверяет файл и собирает чаты (им выдаются новые id), второй потоком отдаёт сообщения в COPY.
+    # Всё — одной транзакцией.
+    try:
+        chats = {}
+        for number, record in iter_import_records(stream):
+            if record.get("type") == "chat":
+                if not isinstance(record.get("id"), str) or record["id"] in chats:
+                    raise ValueError(f"Строка {number}: у чата нет id или он повторяется")
+                title = record.get("title") if isinstance(record.get("title"), str) else "Без названия"
+                if "\x00" in title:
+                    raise ValueError(f"Строка {number}: название чата содержит нулевой символ")
+                chats[record["id"]] = (str(uuid.uuid4()), user_id, title[:30],
+                                       parse_import_timestamp(record.get("created_at"), number))
+            elif record.get("type") == "message":
+                validate_import_message(record, number, chats)
+                parse_import_timestamp(record.get("created_at"), number)
+            else:
+                raise ValueError(f"Строка {number}: неизвестный тип записи {record.get('type')!r}")
+
+        def message_rows():
+            for number, record in iter_import_records(stream):
+                if record["type"] == "message":
+                    role, content, model = validate_import_message(record, number, chats)
+                    yield (chats[record["chat_id"]][0], user_id, role, content, model,
+                           parse_import_timestamp(record.get("created_at"), number))
+
+        messages = CopyRows(message_rows())
+        with db_cursor() as c:
+            c.copy_expert("COPY chats (id, user_id, title, created_at) FROM STDIN WITH (FORMAT csv)",
+                          CopyRows(chats.values()))
+            c.copy_expert("COPY messages (chat_id, user_id, role, content, model, created_at) FROM STDIN WITH (FORMAT csv, FORCE_NULL (model))",
+                          messages, size=EXPORT_CHUNK_BYTES)
+        invalidate_chat_list(user_id)
+        return len(chats), messages.count
+    except ValueError:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка импорта чатов: {str(e)}")
+        raise
+
+# Грубая локальная оценка числа токенов: слово ~ по токену на каждые 3 символа,
+# знаки препинания — отдельные токены, плюс накладные расходы на сообщение
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+def estimate_tokens(text):
+    return sum(math.ceil(len(token) / 3) for token in _TOKEN_RE.findall(text or ""))
+
+def estimate_message_tokens(message):
+    return estimate_tokens(message["content"]) + 4
+
+def build_api_messages(context, user_input, style):
+    # Возвращает сообщения для модели и список сообщений, не поместившихся в бюджет
+    system = [STYLES[style]]
+    if context["summary"]:
+        system.append({"role": "system", "content": f"Краткое содержание предыдущей части разговора: {context['summary']}"})
+    budget = CONTEXT_TOKEN_BUDGET - sum(estimate_message_tokens(m) for m in system) - estimate_tokens(user_input)
+
+    packed = []
+    messages = context["messages"]
+    for message in reversed(messages):
+        cost = estimate_message_tokens(message)
+        if cost > budget:
+            break
+        packed.append({"role": message["role"], "content": message["content"]})
+        budget -= cost
+    packed.reverse()
+    overflow = messages[:len(messages) - len(packed)]
+    return system + packed + [{"role": "user", "content": user_input}], overflow
+
+def summary_boundary(context, overflow):
+    # id, до которого (не включая) сообщения пора свернуть в сводку, или None. Если хвост из
+    # CONTEXT_TAIL_LIMIT сообщений прочитан целиком, до него могут остаться не свёрнутые сообщения,
+    # не попавшие даже в overflow: тогда в сводку идёт всё, что старше первого сообщения окна
+    messages = context["messages"]
+    if not messages or (len(overflow) < SUMMARY_MIN_BATCH and len(messages) < CONTEXT_TAIL_LIMIT):
+        return None
+    return messages[len(overflow)]["id"] if len(overflow) < len(messages) else overflow[-1]["id"] + 1
+
+class UpstreamBusy(Exception):
+    # Запрос к модели не принят: лимит пользователя или переполненная очередь
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = max(int(math.ceil(retry_after)), 1)
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self):
+        # Возвращает 0, если токен взят, иначе сколько секунд ждать следующего
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else math.inf
+
+class LLMScheduler:
+    # Очередь запросов к модели одного event loop: не больше max_concurrency
+    # одновременных запросов, ожидающие обслуживаются по кругу между пользователями,
+    # чтобы один пользователь с пачкой запросов не задерживал остальных.
+    def __init__(self, max_concurrency, queue_max, user_rate, user_burst, queue_timeout=math.inf):
+        self.max_concurrency = max(max_concurrency, 1)
+        self.queue_max = queue_max
+        self.queue_timeout = queue_timeout
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.running = 0
+        self.waiting = 0
+        self.queues = collections.OrderedDict()
+        # Полное ведро ничем не отличается от нового, поэтому храним их не дольше времени наполнения
+        self.buckets = LRUCache(LLM_USER_BUCKETS, user_burst / user_rate if user_rate > 0 else math.inf)
+        self.paused_until = 0.0
+
+    def admit(self, user_id):
+        # Проверка перед началом хода диалога; исключение превращается в ответ 429
+        if self.waiting >= self.queue_max:
+            LLM_REJECTED.inc(reason="queue_full")
+            raise UpstreamBusy("Слишком много запросов к модели, попробуйте чуть позже", self.max_concurrency)
+        bucket = self.buckets.get(user_id) or TokenBucket(self.user_rate, self.user_burst)
+        wait = bucket.take()
+        self.buckets.set(user_id, bucket)
+        if wait:
+            LLM_REJECTED.inc(reason="user_rate")
+            raise UpstreamBusy("Слишком частые запросы, подождите немного", wait)
+
+    def pause(self, seconds):
+        # Апстрим попросил подождать (Retry-After) — новые запросы не отправляются до этого времени
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    @asynccontextmanager
+    async def slot(self, key, purpose):
+        started = time.perf_counter()
+        if self.running < self.max_concurrency and not self.waiting:
+            self.running += 1
+        else:
+            if self.waiting >= self.queue_max:
+                LLM_REJECTED.inc(reason="queue_full")
+                raise UpstreamBusy("Слишком много запросов к модели, попробуйте чуть позже", self.max_concurrency)
+            future = asyncio.get_running_loop().create_future()
+            self.queues.setdefault(key, collections.deque()).append(future)
+            self.waiting += 1
+            try:
+                await asyncio.wait((future,), timeout=self.queue_timeout if math.isfinite(self.queue_timeout) else None)
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self._release()
+                else:
+                    self._forget(key, future)
+                raise
+            if not future.done():
+                # Слот не освободился за queue_timeout: лучше отказ, чем ожидание без первого токена
+                self._forget(key, future)
+                LLM_REJECTED.inc(reason="queue_timeout")
+                raise UpstreamBusy("Модель сейчас занята, попробуйте чуть позже", 5)
+        try:
+            delay = self.paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            LLM_QUEUE_WAIT_SECONDS.observe(time.perf_counter() - started, purpose=purpose)
+            yield
+        finally:
+            self._release()
+
+    def _forget(self, key, future):
+        queue = self.queues.get(key)
+        if queue is not None and future in queue:
+            queue.remove(future)
+            self.waiting -= 1
+            if not queue:
+                del self.queues[key]
+
+    def _release(self):
+        self.running -= 1
+        while self.running < self.max_concurrency and self.queues:
+            key, queue = next(iter(self.queues.items()))
+            future = queue.popleft()
+            self.waiting -= 1
+            if queue:
+                self.queues.move_to_end(key)
+            else:
+                del self.queues[key]
+            if not future.done():
+                self.running += 1
+                future.set_result(None)
+
+_llm_schedulers = {}
+
+def get_llm_scheduler():
+    loop = asyncio.get_running_loop()
+    scheduler = _llm_schedulers.get(loop)
+    if scheduler is None:
+        scheduler = _llm_schedulers[loop] = LLMScheduler(LLM_MAX_CONCURRENCY, LLM_QUEUE_MAX,
+                                                         LLM_USER_RATE, LLM_USER_BURST, LLM_QUEUE_TIMEOUT)
+    return scheduler
+
+LLM_QUEUE_WAITING = Gauge("zhenyagpt_llm_queue_waiting", "Запросы, ждущие слота к модели",
+                          function=lambda: sum(s.waiting for s in list(_llm_schedulers.values())))
+
+def retry_after_seconds(error):
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+async def create_with_retries(create, purpose):
+    # Повторяет запрос при 429/5xx: ждёт Retry-After апстрима (или экспоненциальную
+    # паузу) со случайной добавкой, чтобы повторы разных запросов не совпадали
+    attempt = 0
+    while True:
+        try:
+            return await create()
+        except (RateLimitError, InternalServerError) as e:
+            retry_after = retry_after_seconds(e)
+            if isinstance(e, RateLimitError) and retry_after:
+                get_llm_scheduler().pause(retry_after)
+            delay = retry_after if retry_after is not None else LLM_RETRY_BASE_DELAY * 2 ** attempt
+            if attempt >= LLM_RETRIES or delay > LLM_RETRY_MAX_DELAY:
+                raise
+            attempt += 1
+            LLM_RETRIES_TOTAL.inc(purpose=purpose, status=e.status_code)
+            delay += random.uniform(0, delay / 2)
+            logger.warning(f"Апстрим ответил {e.status_code}, повтор {attempt}/{LLM_RETRIES} через {delay:.1f} с")
+            await asyncio.sleep(delay)
+
+class ModelHealth:
+    # Скользящее окно последних запросов к модели: (время, задержка, успех)
+    def __init__(self, name, cost, index):
+        self.name = name
+        self.cost = cost
+        self.index = index
+        self.samples = collections.deque(maxlen=LLM_HEALTH_WINDOW)
+        self._lock = threading.Lock()
+
+    def record(self, latency, ok):
+        with self._lock:
+            self.samples.append((time.monotonic(), latency, ok))
+
+    def stats(self):
+        # Доля ошибок и медианная задержка успешных запросов; старые замеры не учитываются,
+        # чтобы отключённая из-за ошибок модель со временем снова получила запросы
+        cutoff = time.monotonic() - LLM_HEALTH_TTL
+        with self._lock:
+            samples = [(latency, ok) for at, latency, ok in self.samples if at >= cutoff]
+        if not samples:
+            return 0.0, None, 0
+        latencies = sorted(latency for latency, ok in samples if ok)
+        error_rate = sum(1 for _, ok in samples if not ok) / len(samples)
+        return error_rate, latencies[len(latencies) // 2] if latencies else None, len(samples)
+
+    def healthy(self):
+        error_rate, _, count = self.stats()
+        return count < 5 or error_rate < LLM_UNHEALTHY_ERROR_RATE
+
+class ModelPool:
+    def __init__(self, spec):
+        self.models = []
+        for item in spec.split(","):
+            name, _, cost = item.strip().partition("=")
+            if name:
+                self.models.append(ModelHealth(name.strip(), float(cost) if cost else 0.0, len(self.models)))
+        if not self.models:
+            self.models.append(ModelHealth(IO_MODEL, 0.0, 0))
+        self._by_name = {model.name: model for model in self.models}
+
+    def get(self, name):
+        return self._by_name.get(name)
+
+    def ranked(self, by_cost=False):
+        # Сначала здоровые, затем дешёвые (для названий) и быстрые; модель без замеров
+        # идёт вперёд, чтобы набрать статистику, при равенстве — порядок из LLM_MODELS
+        def key(model):
+            _, latency, _ = model.stats()
+            return (not model.healthy(), model.cost if by_cost else 0, latency or 0, model.index)
+        return [model.name for model in sorted(self.models, key=key)]
+
+    def chat_model(self):
+        return self.ranked()[0]
+
+    def title_model(self):
+        return self.ranked(by_cost=True)[0]
+
+    def error_rates(self):
+        return {(model.name,): model.stats()[0] for model in self.models}
+
+    def latencies(self):
+        return {(model.name,): model.stats()[1] for model in self.models if model.stats()[1] is not None}
+
+model_pool = ModelPool(LLM_MODELS)
+
+LLM_MODEL_ERROR_RATE = Gauge("zhenyagpt_llm_model_error_rate", "Доля ошибок модели в окне здоровья", ("model",),
+                             function=model_pool.error_rates)
+LLM_MODEL_LATENCY = Gauge("zhenyagpt_llm_model_latency_seconds", "Медианная задержка модели в окне здоровья", ("model",),
+                          function=model_pool.latencies)
+LLM_HEDGES = Counter("zhenyagpt_llm_hedges_total", "Хедж-запросы к следующей модели из-за медленного первого токена", ("model",))
+LLM_FAILOVERS = Counter("zhenyagpt_llm_failovers_total", "Переходы на следующую модель после ошибки до первого токена", ("model",))
+
+async def close_stream(task, agen):
+    if not task.done():
+        task.cancel()
+    try:
+        await task
+    except BaseException:
+        pass
+    await agen.aclose()
+
+async def hedged_stream(messages, style, user_id=None):
+    # Отдаёт пары (модель, кусок ответа). Модели пробуются в порядке здоровья: если
+    # первый токен не пришёл за LLM_HEDGE_AFTER секунд, параллельно запускается
+    # следующая, если модель упала до первого токена — следующая сразу. Побеждает
+    # первая модель, приславшая токен; остальные стримы закрываются.
+    candidates = model_pool.ranked()
+    streams = {}
+    winner = None
+    last_error = None
+
+    def launch():
+        model = candidates.pop(0)
+        agen = stream_response_from_api(messages, style, user_id, model)
+        streams[asyncio.ensure_future(agen.__anext__())] = (model, agen)
+
+    launch()
+    try:
+        while streams and winner is None:
+            hedge_after = LLM_HEDGE_AFTER if candidates and LLM_HEDGE_AFTER > 0 else None
+            done, _ = await asyncio.wait(streams, timeout=hedge_after, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                logger.warning(f"Нет первого токена за {LLM_HEDGE_AFTER} с, запрашиваем также {candidates[0]}")
+                LLM_HEDGES.inc(model=candidates[0])
+                launch()
+                continue
+            for task in done:
+                model, agen = streams.pop(task)
+                try:
+                    first = task.result()
+                except StopAsyncIteration:
+                    first = None
+                except UpstreamBusy:
+                    # Очередь переполнена или ожидание истекло: другая модель ждала бы в той же очереди
+                    await agen.aclose()
+                    raise
+                except Exception as e:
+                    last_error = e
+                    await agen.aclose()
+                    if candidates:
+                        logger.warning(f"Модель {model} не ответила ({str(e)}), переключаемся на {candidates[0]}")
+                        LLM_FAILOVERS.inc(model=model)
+                        launch()
+                    continue
+                if winner is None:
+                    winner = (model, agen, first)
+                else:
+                    await agen.aclose()
+    except BaseException:
+        if winner is not None:
+            await winner[1].aclose()
+        raise
+    finally:
+        for task, (_, agen) in list(streams.items()):
+            await close_stream(task, agen)
+        streams.clear()
+
+    if winner is None:
+        raise last_error
+    model, agen, first = winner
+    try:
+        if first is None:
+            return
+        yield model, first
+        async for delta in agen:
+            yield model, delta
+    finally:
+        await agen.aclose()
+
+_summaries_in_progress = set()
+
+async def update_chat_summary(user_id, chat_id, context, before_id):
+    # Инкрементально дописывает в сводку сообщения, выпавшие из окна контекста (с id < before_id)
+    if chat_id in _summaries_in_progress:
+        return
+    _summaries_in_progress.add(chat_id)
+    try:
+        batch = await run_db(get_messages_to_summarize, chat_id, context["summary_upto"], before_id)
+        if not batch or len(batch) < SUMMARY_MIN_BATCH:
+            return
+        transcript = "\n".join(f"{m['role']}: {m['content'][:2000]}" for m in batch)
+        model = model_pool.chat_model()
+        completion = await observe_llm_call("summary", model, functools.partial(
+            get_async_client().chat.completions.create,
+            model=model,
             messages=[
-                {"role": "system", "content": "Ты — помощник, который генерирует короткие названия для чатов (до 30 символов) на основе первого сообщения пользователя. Название должно быть понятным и отражать суть сообщения. Ответь только названием, без лишнего текста."},
+                {"role": "system", "content": "Ты ведёшь краткое содержание диалога пользователя с ассистентом. Обнови содержание с учётом новых реплик: сохрани факты, имена, договорённости и открытые вопросы. Не больше 200 слов. Ответь только содержанием."},
+                {"role": "user", "content": f"Текущее содержание:\n{context['summary'] or '—'}\n\nНовые реплики:\n{transcript}"}
+            ],
+            max_tokens=400,
+            temperature=0.3
+        ), SUMMARY_TIMEOUT, key=user_id)
+        summary = completion.choices[0].message.content.strip()
+        if summary:
+            await run_db(save_chat_summary, chat_id, summary, batch[-1]["id"])
+            logger.debug("Сводка чата %s обновлена до сообщения %s", chat_id, batch[-1]['id'])
+    except Exception as e:
+        logger.error(f"Ошибка обновления сводки чата: {str(e)}")
+    finally:
+        _summaries_in_progress.discard(chat_id)
+
+async def stream_response_from_api(messages, style, user_id=None, model=IO_MODEL):
+    # Отдаёт куски ответа по мере генерации; ошибки пробрасываются вызывающему.
+    # Слот планировщика занят до конца стрима; метрики задержки считаются от получения слота.
+    async with get_llm_scheduler().slot(user_id, "chat"):
+        start_time = time.perf_counter()
+        first_token_time = None
+        error = None
+        LLM_REQUESTS_IN_FLIGHT.inc(purpose="chat")
+        try:
+            stream = await create_with_retries(functools.partial(
+                get_async_client().chat.completions.create,
+                model=model,
+                messages=messages,
+                max_tokens=1500,
+                temperature=0.9,
+                top_p=0.95,
+                stream=True
+            ), "chat")
+            try:
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        if first_token_time is None:
+                            first_token_time = time.perf_counter()
+                            LLM_TTFT_SECONDS.observe(first_token_time - start_time, model=model, style=style)
+                            logger.debug("Время до первого токена: %.2f секунд", first_token_time - start_time)
+                        yield delta
+            finally:
+                await stream.close()
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            LLM_REQUESTS_IN_FLIGHT.dec(purpose="chat")
+            record_llm_call(model, "chat", style, time.perf_counter() - start_time, error,
+                            first_token_time - start_time if first_token_time is not None else None)
+            logger.debug("Время ответа API: %.2f секунд", time.perf_counter() - start_time)
+
+TITLE_PROMPT = "Ты — помощник, который генерирует короткие названия для чатов (до 30 символов) на основе первого сообщения пользователя. Название должно быть понятным и отражать суть сообщения. Ответь только названием, без лишнего текста."
+
+async def generate_chat_title(user_input, user_id=None):
+    try:
+        # Для названий достаточно самой дешёвой и быстрой модели. Генерация детерминированная
+        # (temperature=0), поэтому одинаковые первые сообщения отдаются из кэша.
+        model = model_pool.title_model()
+        if TITLE_CACHE:
+            cached = await run_db(response_cache.get, "title", [
+                response_cache_key("title", name, TITLE_PROMPT, [], user_input) for name in model_pool.ranked(by_cost=True)])
+            if cached is not None:
+                return cached["response"]
+        completion = await observe_llm_call("title", model, functools.partial(
+            get_async_client().chat.completions.create,
+            model=model,
+            messages=[
+                {"role": "system", "content": TITLE_PROMPT},
                 {"role": "user", "content": f"Сгенерируй название для чата на основе этого сообщения: {user_input}"}
             ],
             max_tokens=30,
-            temperature=0.9,
-            top_p=0.95
-        )
+            temperature=0
+        ), TITLE_TIMEOUT, key=user_id)
         
         title = completion.choices[0].message.content.strip()
-        logger.debug(f"Получен заголовок от API: {title[:50]}...")
+        logger.debug("Получен заголовок от API: %.50s...", title)
+        if TITLE_CACHE and title:
+            await run_db(response_cache.set, "title", response_cache_key("title", model, TITLE_PROMPT, [], user_input),
+                         model, title[:30])
         return title[:30]
+    except asyncio.TimeoutError:
+        logger.warning(f"Заголовок не сгенерирован за {TITLE_TIMEOUT} секунд, используем начало сообщения")
+        return user_input[:30]
     except Exception as e:
         logger.error(f"Ошибка при запросе к API для заголовка: {str(e)}")
         return user_input[:30]
 
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора до завершения
+_background_tasks = set()
+
+def spawn_background(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def save_title_when_ready(chat_id, title_task):
+    title = await title_task
+    if title:
+        await run_db(update_chat_title, chat_id, title)
+    return title
+
+def register_request(request_id, user_id):
+    ensure_cancellation_listener()
+    cancel_event = asyncio.Event()
+    with _active_requests_lock:
+        active_requests[request_id] = {"user_id": user_id, "loop": asyncio.get_running_loop(), "cancel": cancel_event}
+    return cancel_event
+
+def unregister_request(request_id):
+    with _active_requests_lock:
+        active_requests.pop(request_id, None)
+
+def cancel_local_requests(user_id=None, request_id=None):
+    # user_id=None — отмена без проверки владельца (например, при отключении клиента)
+    with _active_requests_lock:
+        targets = [entry for rid, entry in active_requests.items()
+                   if (user_id is None or entry["user_id"] == user_id) and (request_id is None or rid == request_id)]
+    for entry in targets:
+        entry["loop"].call_soon_threadsafe(entry["cancel"].set)
+    return len(targets)
+
+@db_helper
+def publish_cancel(user_id, request_id):
+    # Ход может выполняться в другом воркере — рассылаем отмену через NOTIFY
+    with db_cursor() as c:
+        c.execute("SELECT pg_notify(%s, %s)", (CANCEL_CHANNEL, json.dumps({"user_id": user_id, "request_id": request_id})))
+
+class CancellationListener(threading.Thread):
+    # Слушает LISTEN chat_cancel на отдельном соединении и отменяет локальные запросы
+    def __init__(self, dsn):
+        super().__init__(name="cancel-listener", daemon=True)
+        self.dsn = dsn
+
+    def run(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as c:
+                    c.execute(f"LISTEN {CANCEL_CHANNEL}")
+                while True:
+                    if select.select([conn], [], [], 30) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        payload = json.loads(conn.notifies.pop(0).payload)
+                        cancel_local_requests(payload["user_id"], payload.get("request_id"))
+            except Exception as e:
+                logger.error(f"Ошибка слушателя отмены запросов: {str(e)}")
+                time.sleep(5)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+_cancellation_listener = None
+
+def ensure_cancellation_listener():
+    global _cancellation_listener
+    if _cancellation_listener is None:
+        with _active_requests_lock:
+            if _cancellation_listener is None:
+                _cancellation_listener = CancellationListener(os.getenv("DATABASE_URL"))
+                _cancellation_listener.start()
+
+async def iterate_until_cancelled(agen, cancel_event):
+    # Отдаёт элементы agen, пока запрос не отменён. Ожидание следующего куска
+    # прерывается сразу, и генератор закрывает поток к модели в своём finally.
+    cancel_wait = asyncio.ensure_future(cancel_event.wait())
+    try:
+        while not cancel_event.is_set():
+            next_item = asyncio.ensure_future(agen.__anext__())
+            await asyncio.wait([next_item, cancel_wait], return_when=asyncio.FIRST_COMPLETED)
+            if not next_item.done():
+                next_item.cancel()
+                try:
+                    await next_item
+                except (asyncio.CancelledError, StopAsyncIteration):
+                    pass
+                return
+            try:
+                item = next_item.result()
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        cancel_wait.cancel()
+        await agen.aclose()
+
+async def replay_cached_response(cached):
+    yield cached["model"], cached["response"]
+
+def ndjson_event(event):
+    return json.dumps(event, ensure_ascii=False) + "\n"
+
+async def chat_turn_events(request_id, user_id, chat_id, context, user_input, style, trace):
+    # Один ход диалога в виде событий start/title/delta/error/cancelled/done.
+    # Вопрос и ответ сохраняются одной транзакцией, когда стрим завершился, был
+    # остановлен или клиент отключился; при остановке сохраняется уже полученная часть.
+    cancel_event = register_request(request_id, user_id)
+    yield {"type": "start", "request_id": request_id}
+
+    # Название чата генерируется параллельно с ответом и не задерживает его.
+    # Готовое к концу хода название пишется вместе с ним, иначе — фоновой задачей,
+    # которая допишет его в БД, даже если клиент отключится.
+    is_first_message = not context["messages"] and not context["summary"]
+    title_task = spawn_background(generate_chat_title(user_input, user_id)) if is_first_message else None
+    title_write = None
+    title_sent = False
+    with trace.span("build_context"):
+        api_messages, overflow = build_api_messages(context, user_input, style)
+
+    def ready_title():
+        if title_task is None or not title_task.done() or title_task.cancelled() or title_task.exception():
+            return None
+        return title_task.result() or None
+
+    def title_event():
+        nonlocal title_sent
+        title = ready_title()
+        if title is None or title_sent:
+            return None
+        title_sent = True
+        return {"type": "title", "chat_id": chat_id, "title": title}
+
+    # Для стилей из RESPONSE_CACHE_STYLES готовый ответ берётся из кэша вместо запроса к модели
+    cached = None
+    cache_history = cacheable_reply_history(style, context, api_messages)
+    if cache_history is not None:
+        def cache_key(model):
+            return response_cache_key("reply", model, STYLES[style]["content"], cache_history, user_input)
+        with trace.span("response_cache"):
+            cached = await run_db(response_cache.get, "reply", [cache_key(model) for model in model_pool.ranked()])
+    source = replay_cached_response(cached) if cached is not None else hedged_stream(api_messages, style, user_id)
+
+    parts = []
+    served_model = None
+    error = None
+    save_error = None
+    llm_started = time.perf_counter()
+    try:
+        async for model, delta in iterate_until_cancelled(source, cancel_event):
+            if not parts:
+                trace.add("llm_first_token", llm_started)
+                served_model = model
+            parts.append(delta)
+            yield {"type": "delta", "content": delta}
+            event = title_event()
+            if event:
+                yield event
+        if cancel_event.is_set():
+            logger.info("Запрос %s остановлен", request_id)
+            yield {"type": "cancelled", "request_id": request_id}
+        elif cache_history is not None and cached is None and parts:
+            spawn_background(run_db(response_cache.set, "reply", cache_key(served_model), served_model, "".join(parts)))
+    except UpstreamBusy as e:
+        logger.warning(f"Запрос {request_id} не попал в очередь к модели: {str(e)}")
+        error = f"Ошибка: {str(e)}"
+        yield {"type": "error", "content": error}
+    except RateLimitError as e:
+        logger.error(f"Апстрим ограничил запросы: {str(e)}")
+        error = "Ошибка: модель сейчас перегружена, попробуйте через минуту"
+        yield {"type": "error", "content": error}
+    except Exception as e:
+        logger.error(f"Ошибка при запросе к API: {str(e)}")
+        error = f"Ошибка: {str(e)}"
+        yield {"type": "error", "content": error}
+    finally:
+        trace.add("llm_stream", llm_started)
+        unregister_request(request_id)
+        ai_reply = "".join(parts) or error
+        title = ready_title()
+        turn_messages = [("user", user_input, None)] + ([("assistant", ai_reply, served_model)] if ai_reply else [])
+        try:
+            with trace.span("save_turn"):
+                await run_db(save_chat_turn, user_id, chat_id, turn_messages, title)
+        except Exception as e:
+            save_error = e
+        if title_task is not None and title is None:
+            title_write = spawn_background(save_title_when_ready(chat_id, title_task))
+        # Старые сообщения, не вошедшие в окно, сворачиваются в сводку в фоне
+        before_id = summary_boundary(context, overflow)
+        if before_id is not None:
+            spawn_background(update_chat_summary(user_id, chat_id, context, before_id))
+
+    if save_error is not None:
+        yield {"type": "error", "content": f"Ошибка: сообщение не сохранено ({save_error})"}
+    event = title_event()
+    if event:
+        yield event
+    with trace.span("load_chats"):
+        chats, chats_cursor = await run_db(get_chats_page, user_id)
+    yield {"type": "done", "chats": chats, "chats_cursor": chats_cursor}
+    # Ход завершён, клиент уже может писать дальше; не готовое к этому моменту название
+    # досылается отдельным событием, когда фоновая задача его запишет (не дольше TITLE_TIMEOUT)
+    if title_write is not None:
+        with trace.span("wait_title"):
+            await asyncio.wait([title_write])
+        event = title_event()
+        if event:
+            yield event
+
+async def collect_chat_reply(events):
+    # Ответ без стрима готов на событии done; название, если оно ещё генерируется,
+    # допишет в БД фоновая задача
+    reply = []
+    chats = {}
+    try:
+        async for event in events:
+            if event["type"] in ("delta", "error"):
+                reply.append(event["content"])
+            elif event["type"] == "done":
+                chats = event["chats"]
+                break
+    finally:
+        await events.aclose()
+    return "".join(reply), chats
+
+def wants_stream():
+    return request.form.get("stream") == "1" or "application/x-ndjson" in request.headers.get("Accept", "")
+
+@db_helper
+def prepare_chat():
+    user_id = session['user_id']
+    if 'active_chat' not in session or not chat_exists(user_id, session['active_chat']):
+        chat_id = str(uuid.uuid4())
+        add_chat(chat_id, user_id)
+        session['active_chat'] = chat_id
+        logger.info("Создан новый чат %s для пользователя %s", chat_id, user_id)
+
+    chat_id = session['active_chat']
+    current_style = get_session_style(user_id)
+    return user_id, chat_id, current_style
+
+async def chat_post():
+    # Возвращает (response, events): для стрима events — асинхронный генератор тела ответа
+    request_id = str(uuid.uuid4())
+    # Трасса завершается в teardown запроса, когда ответ отдан целиком
+    trace = g._trace = RequestTrace(request_id)
+    try:
+        with trace.span("prepare_chat"):
+            user_id, chat_id, current_style = await run_db(prepare_chat)
+        with trace.span("load_context"):
+            context = await run_db(get_chat_context, chat_id)
+
+        user_input = request.form.get("user_input", "").strip()
+        if not user_input:
+            return app.make_response((jsonify({"ai_response": "Пустой запрос."}), 400)), None
+        try:
+            get_llm_scheduler().admit(user_id)
+        except UpstreamBusy as e:
+            response = app.make_response((jsonify({"ai_response": str(e)}), 429))
+            response.headers["Retry-After"] = str(e.retry_after)
+            return response, None
+
+        logger.debug("Получен запрос от пользователя %s: %.200s", user_id, user_input)
+        events = chat_turn_events(request_id, user_id, chat_id, context, user_input, current_style, trace)
+
+        if wants_stream():
+            response = Response(mimetype="application/x-ndjson",
+                                headers={"X-Accel-Buffering": "no", "Cache-Control": "no-cache", "X-Request-Id": request_id})
+            return response, events
+
+        ai_reply, chats = await collect_chat_reply(events)
+        logger.debug("Успешный ответ: %.50s...", ai_reply)
+        response = app.make_response(jsonify({"ai_response": ai_reply, "chats": chats, "request_id": request_id}))
+        return response, None
+    except Exception as e:
+        logger.error(f"Ошибка в маршруте index: {str(e)}")
+        return app.make_response((jsonify({"ai_response": f"Ошибка на сервере: {str(e)}"}), 500)), None
+
+@app.before_request
+def start_request_timer():
+    g._request_started = time.perf_counter()
+    HTTP_REQUESTS_IN_FLIGHT.inc()
+
+@app.after_request
+def remember_response_status(response):
+    g._response_status = response.status_code
+    return response
+
+@app.teardown_request
+def observe_request(exc):
+    # stream_with_context повторяет teardown после отдачи последнего куска;
+    # стримящие маршруты выставляют g._stream_pending, чтобы учесть запрос тогда
+    if g.pop('_stream_pending', False):
+        return
+    started = g.pop('_request_started', None)
+    if started is None:
+        return
+    HTTP_REQUESTS_IN_FLIGHT.dec()
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    status = 500 if exc is not None else g.get('_response_status', 500)
+    HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, method=request.method, route=route, status=status)
+    trace = g.pop('_trace', None)
+    if trace is not None:
+        trace.finish()
+
 @app.before_request
 def require_login():
-    if request.endpoint not in ['login', 'register', 'static'] and 'user_id' not in session:
+    # Список чатов раньше хранился в cookie — убираем его из старых сессий
+    if 'chats' in session:
+        session.pop('chats')
+    if request.endpoint not in ['login', 'register', 'static', 'db_stats', 'metrics'] and 'user_id' not in session:
         return redirect(url_for('login'))
 
+AUTH_REJECTED = Counter("zhenyagpt_auth_rejected_total", "Входы и регистрации, отклонённые до проверки пароля",
+                        ("reason",))
+AUTH_HASH_SECONDS = Histogram("zhenyagpt_auth_hash_seconds", "Время хеширования или проверки пароля, включая очередь",
+                              ("op",), buckets=HTTP_BUCKETS)
+
+class AuthBusy(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+# Хеширование паролей намеренно дорогое по CPU: оно идёт в отдельном небольшом пуле, чтобы волна
+# входов не занимала все потоки WSGI и ядра. Сверх AUTH_QUEUE_MAX запрос ждёт освободившегося
+# места, и только если за AUTH_QUEUE_TIMEOUT его не нашлось — отказ.
+auth_executor = ThreadPoolExecutor(max_workers=AUTH_WORKERS, thread_name_prefix="auth")
+auth_slots = threading.BoundedSemaphore(AUTH_QUEUE_MAX)
+
+def run_auth(op, func, *args):
+    if not auth_slots.acquire(timeout=AUTH_QUEUE_TIMEOUT):
+        AUTH_REJECTED.inc(reason="busy")
+        raise AuthBusy("Сервер перегружен входами, попробуйте через минуту", 5)
+    start = time.perf_counter()
+    try:
+        return auth_executor.submit(func, *args).result()
+    finally:
+        auth_slots.release()
+        AUTH_HASH_SECONDS.observe(time.perf_counter() - start, op=op)
+
+class LoginBuckets:
+    # Корзины токенов по имени пользователя, не больше maxsize. Вытесняется только корзина, которая
+    # простояла дольше времени полного наполнения (она ничем не отличается от новой), иначе перебор
+    # мусорных имён сбрасывал бы лимит атакуемого. Если таких нет, новое имя ждёт освобождения места.
+    def __init__(self, rate, capacity, maxsize):
+        self.rate = rate
+        self.capacity = capacity
+        self.maxsize = max(maxsize, 1)
+        self.refill_time = capacity / rate if rate > 0 else math.inf
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        # Возвращает 0, если попытка разрешена, иначе сколько секунд ждать
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                wait = self._make_room()
+                if wait:
+                    return wait
+                bucket = TokenBucket(self.rate, self.capacity)
+            wait = bucket.take()
+            self._buckets[key] = bucket
+            return wait
+
+    def _make_room(self):
+        # Корзины упорядочены по последнему обращению: самая давняя простояла дольше всех
+        now = time.monotonic()
+        while len(self._buckets) >= self.maxsize:
+            oldest = next(iter(self._buckets.values()))
+            idle = now - oldest.updated
+            if idle < self.refill_time:
+                return self.refill_time - idle
+            self._buckets.popitem(last=False)
+        return 0
+
+    def delete(self, key):
+        with self._lock:
+            self._buckets.pop(key, None)
+
+# Попытки входа на имя пользователя: корзина токенов, как у лимита запросов к модели
+login_buckets = LoginBuckets(LOGIN_RATE, LOGIN_BURST, LOGIN_BUCKETS)
+
+def take_login_attempt(username):
+    wait = login_buckets.take(username)
+    if wait:
+        AUTH_REJECTED.inc(reason="login_rate")
+        raise AuthBusy("Слишком много попыток входа, попробуйте позже", math.ceil(wait))
+
+def auth_busy_response(template, error):
+    response = app.make_response((render_template(template, error=str(error)), 429))
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
+
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
@@ -309,16 +2354,11 @@ def register():
         password = request.form.get('password')
         if username and password:
             try:
-                conn = get_db_connection()
-                c = conn.cursor()
-                c.execute("INSERT INTO users (username, password) VALUES (%s, %s) RETURNING id",
-                         (username, generate_password_hash(password)))
-                user_id = c.fetchone()[0]
-                c.execute("INSERT INTO user_settings (user_id, style) VALUES (%s, %s)", (user_id, "sassy"))
-                conn.commit()
-                conn.close()
-                logger.info(f"Зарегистрирован новый пользователь: {username}")
+                create_user(username, run_auth("hash", generate_password_hash, password))
+                logger.info("Зарегистрирован новый пользователь: %s", username)
                 return redirect(url_for('login'))
+            except AuthBusy as e:
+                return auth_busy_response('register.html', e)
             except psycopg2.IntegrityError:
                 logger.warning(f"Попытка зарегистрировать существующего пользователя: {username}")
                 return render_template('register.html', error="Пользователь с таким именем уже существует")
@@ -333,19 +2373,20 @@ def login():
         username = request.form.get('username')
         password = request.form.get('password')
         try:
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("SELECT id, password FROM users WHERE username = %s", (username,))
-            user = c.fetchone()
-            conn.close()
-            if user and check_password_hash(user[1], password):
+            take_login_attempt(username)
+            user = get_user_credentials(username)
+            if user and run_auth("check", check_password_hash, user[1], password):
+                login_buckets.delete(username)
                 session['user_id'] = user[0]
                 session['username'] = username
-                session['chats'] = get_all_chats(user[0])
-                logger.info(f"Пользователь {username} вошёл в систему")
+                remember_session_style(user[2])
+                logger.info("Пользователь %s вошёл в систему", username)
                 return redirect(url_for('index'))
             logger.warning(f"Неудачная попытка входа для {username}")
             return render_template('login.html', error="Неверное имя пользователя или пароль")
+        except AuthBusy as e:
+            logger.warning(f"Вход для {username} отклонён: {str(e)}")
+            return auth_busy_response('login.html', e)
         except Exception as e:
             logger.error(f"Ошибка при входе: {str(e)}")
             return render_template('login.html', error="Ошибка сервера")
@@ -357,6 +2398,7 @@ def logout():
     session.pop('username', None)
     session.pop('active_chat', None)
     session.pop('chats', None)
+    session.pop('style', None)
     logger.info("Пользователь вышел из системы")
     return redirect(url_for('login'))
 
@@ -366,68 +2408,123 @@ def change_style():
     style = request.form.get("style")
     if style in STYLES:
         set_user_style(user_id, style)
-        logger.info(f"Стиль пользователя {user_id} изменён на {style}")
+        logger.info("Стиль пользователя %s изменён на %s", user_id, style)
     return redirect(url_for("index"))
 
 @app.route("/", methods=["GET", "POST"])
-async def index():
-    try:
-        user_id = session['user_id']
-        if 'chats' not in session:
-            session['chats'] = get_all_chats(user_id)
-
-        if 'active_chat' not in session or not chat_exists(user_id, session['active_chat']):
-            chat_id = str(uuid.uuid4())
-            add_chat(chat_id, user_id)
-            session['active_chat'] = chat_id
-            session['chats'][chat_id] = {"title": "Без названия", "history": []}
-            logger.info(f"Создан новый чат {chat_id} для пользователя {user_id}")
-
-        chat_id = session['active_chat']
-        history = get_chat_history(chat_id)
-        current_style = get_user_style(user_id)
-
-        if request.method == "POST":
-            user_input = request.form.get("user_input", "").strip()
-            if not user_input:
-                return jsonify({"ai_response": "Пустой запрос."}), 400
-
-            logger.debug(f"Получен запрос от пользователя {user_id}: {user_input}")
-            add_message(chat_id, "user", user_input)
-
-            # Генерируем название чата от ИИ, если это первое сообщение
-            if not history:
-                request_id = str(uuid.uuid4())
-                active_requests[request_id] = True
-                title_task = asyncio.create_task(generate_chat_title(user_input, request_id))
-                title = await title_task
-                if title and request_id in active_requests:
-                    update_chat_title(chat_id, title)
-                    session['chats'][chat_id]['title'] = title
-                if request_id in active_requests:
-                    del active_requests[request_id]
-
-            # Обрабатываем основной запрос
-            ai_reply = get_response_from_api(history, user_input, current_style)
-            add_message(chat_id, "assistant", ai_reply)
-            session['chats'] = get_all_chats(user_id)  # Обновляем кэш
-            logger.debug(f"Успешный ответ: {ai_reply[:50]}...")
-            return jsonify({"ai_response": ai_reply, "chats": session['chats']})
-
-        return render_template("index.html", history=history, chats=session['chats'], active_chat=chat_id, 
+def index():
+    # Под uvicorn POST / обрабатывается нативно в ChatASGIApp; здесь — WSGI-режим
+    if request.method == "POST":
+        response, events = run_async(chat_post())
+        if events is not None:
+            g._stream_pending = True
+            response.response = stream_with_context(ndjson_event(event) for event in iterate_async(events))
+        return response
+
+    try:
+        user_id, chat_id, current_style = prepare_chat()
+        history, history_cursor = get_chat_page(chat_id)
+        chats, chats_cursor = get_chats_page(user_id)
+        return render_template("index.html", history=history, history_cursor=history_cursor, chats=chats,
+                              chats_cursor=chats_cursor, active_chat=chat_id,
                               current_style=current_style, styles=STYLES.keys())
     except Exception as e:
         logger.error(f"Ошибка в маршруте index: {str(e)}")
         return jsonify({"ai_response": f"Ошибка на сервере: {str(e)}"}), 500
 
+def page_limit(default):
+    # Размер страницы из ?limit=, от 1 до 100: LIMIT 0 отдал бы курсор, пропускающий строку,
+    # а отрицательный Postgres отвергает, и страница выглядела бы как конец списка
+    value = request.args.get("limit", default)
+    try:
+        return max(1, min(int(value), 100))
+    except (TypeError, ValueError):
+        raise ValueError(f"Некорректный limit: {value}")
+
+@app.route("/history/<chat_id>")
+def chat_history_page(chat_id):
+    user_id = session['user_id']
+    if not chat_exists(user_id, chat_id):
+        return jsonify({"error": "Чат не найден"}), 404
+    try:
+        limit = page_limit(HISTORY_PAGE_SIZE)
+        messages, next_cursor = get_chat_page(chat_id, request.args.get("before"), limit)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"messages": messages, "next_cursor": next_cursor})
+
+@app.route("/chats")
+def chats_page():
+    user_id = session['user_id']
+    try:
+        limit = page_limit(CHATS_PAGE_SIZE)
+        chats, next_cursor = get_chats_page(user_id, request.args.get("before"), limit)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    # Списком, а не словарём: jsonify сортирует ключи и теряет порядок по last_active
+    chats = [{"id": chat_id, "title": chat_data["title"]} for chat_id, chat_data in chats.items()]
+    return jsonify({"chats": chats, "next_cursor": next_cursor})
+
+@app.route("/search")
+def search():
+    user_id = session['user_id']
+    query = request.args.get("q", "").strip()
+    if not query:
+        return jsonify({"error": "Пустой запрос"}), 400
+    try:
+        limit = page_limit(SEARCH_PAGE_SIZE)
+        results, next_cursor, truncated = search_messages(user_id, query, request.args.get("cursor"), limit)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"results": results, "next_cursor": next_cursor, "truncated": truncated})
+
+@app.route("/export")
+def export():
+    user_id = session['user_id']
+    export_format = request.args.get("format", "jsonl")
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"error": f"Неизвестный формат: {export_format}"}), 400
+    chat_id = request.args.get("chat_id")
+    if chat_id and not chat_exists(user_id, chat_id):
+        return jsonify({"error": "Чат не найден"}), 404
+    mimetype, extension, _ = EXPORT_FORMATS[export_format]
+    if not export_slots.acquire(blocking=False):
+        response = app.make_response((jsonify({"error": "Слишком много одновременных выгрузок, попробуйте позже"}), 429))
+        response.headers["Retry-After"] = "10"
+        return response
+    g._stream_pending = True
+    response = Response(stream_with_context(export_chunks(user_id, chat_id, export_format)), mimetype=mimetype,
+                        headers={"Content-Disposition": f'attachment; filename="zhenyagpt-{chat_id or "chats"}.{extension}"'})
+    # Слот освобождается при закрытии ответа — и после полной отдачи, и после отключения клиента
+    response.call_on_close(export_slots.release)
+    return response
+
+@app.route("/import", methods=["POST"])
+def import_route():
+    user_id = session['user_id']
+    if request.content_length is not None and request.content_length > IMPORT_MAX_BYTES:
+        return jsonify({"error": "Файл слишком большой"}), 413
+    upload = request.files.get("file")
+    if upload is None:
+        return jsonify({"error": "Файл не передан"}), 400
+    try:
+        chats, messages = import_chats(user_id, upload.stream)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except psycopg2.DataError:
+        return jsonify({"error": "Файл содержит данные, которые нельзя сохранить"}), 400
+    except psycopg2.Error:
+        return jsonify({"error": "Не удалось импортировать чаты"}), 500
+    logger.info("Пользователь %s импортировал %s чатов и %s сообщений", user_id, chats, messages)
+    return jsonify({"chats": chats, "messages": messages})
+
 @app.route("/new_chat")
 def new_chat():
     user_id = session['user_id']
     chat_id = str(uuid.uuid4())
     add_chat(chat_id, user_id)
     session["active_chat"] = chat_id
-    session['chats'] = get_all_chats(user_id)
-    logger.info(f"Создан новый чат {chat_id} для пользователя {user_id}")
+    logger.info("Создан новый чат %s для пользователя %s", chat_id, user_id)
     return redirect(url_for("index"))
 
 @app.route("/switch_chat/<chat_id>")
@@ -436,8 +2533,7 @@ def switch_chat(chat_id):
     if chat_exists(user_id, chat_id):
         session["active_chat"] = chat_id
         update_chat_last_active(chat_id)
-        session['chats'] = get_all_chats(user_id)
-        logger.info(f"Переключение на чат {chat_id} для пользователя {user_id}")
+        logger.info("Переключение на чат %s для пользователя %s", chat_id, user_id)
     else:
         logger.warning(f"Чат {chat_id} не существует, создаём новый")
         return redirect(url_for("new_chat"))
@@ -448,9 +2544,7 @@ def reset_chat_route(chat_id):
     user_id = session['user_id']
     if chat_exists(user_id, chat_id):
         reset_chat(chat_id)
-        session['chats'][chat_id]['title'] = "Без названия"
-        session['chats'] = get_all_chats(user_id)
-        logger.info(f"Чат {chat_id} сброшен для пользователя {user_id}")
+        logger.info("Чат %s сброшен для пользователя %s", chat_id, user_id)
     return redirect(url_for("index"))
 
 @app.route("/delete_chat/<chat_id>", methods=["POST"])
@@ -462,18 +2556,29 @@ def delete_chat_route(chat_id):
             new_chat_id = str(uuid.uuid4())
             add_chat(new_chat_id, user_id)
             session["active_chat"] = new_chat_id
-            session['chats'][new_chat_id] = {"title": "Без названия", "history": []}
-        session['chats'].pop(chat_id, None)
-        session['chats'] = get_all_chats(user_id)
-        logger.info(f"Чат {chat_id} удалён для пользователя {user_id}")
+        logger.info("Чат %s удалён для пользователя %s", chat_id, user_id)
     return redirect(url_for("index"))
 
 @app.route("/stop_response", methods=["POST"])
 def stop_response():
-    for request_id in list(active_requests.keys()):
-        active_requests[request_id] = False
-    logger.info("Все активные запросы остановлены")
-    return jsonify({"status": "stopped"})
+    # Останавливает запрос request_id (или все запросы) только текущего пользователя
+    user_id = session['user_id']
+    request_id = request.form.get("request_id") or None
+    cancel_local_requests(user_id, request_id)
+    try:
+        publish_cancel(user_id, request_id)
+    except Exception as e:
+        logger.error(f"Ошибка рассылки отмены запроса: {str(e)}")
+    logger.info("Остановлены запросы пользователя %s: %s", user_id, request_id or 'все')
+    return jsonify({"status": "stopped", "request_id": request_id})
+
+@app.route("/db_stats")
+def db_stats():
+    return jsonify(get_db_pool().stats())
+
+@app.route("/metrics")
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
 
 @app.route("/clear_session")
 def clear_session():
@@ -481,10 +2586,268 @@ def clear_session():
     logger.info("Сессия очищена")
     return redirect(url_for("login"))
 
-# Оборачиваем Flask-приложение в ASGI
-asgi_app = WsgiToAsgi(app)
+class JsonLogFormatter(logging.Formatter):
+    # Одна JSON-строка на запись: удобно для сборщиков логов
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class LogSampler(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    # Стандартный prepare форматирует запись в вызывающем потоке; очередь внутри процесса,
+    # поэтому запись передаётся как есть, а форматирование и вывод делает поток QueueListener
+    def prepare(self, record):
+        return record
+
+_log_listener = None
+
+def configure_logging():
+    global _log_listener
+    root = logging.getLogger()
+    if any(getattr(handler, "zhenyagpt", False) for handler in root.handlers):
+        return
+    if not PRODUCTION_LOGGING:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    else:
+        output = logging.StreamHandler(sys.stdout)
+        output.setFormatter(JsonLogFormatter())
+        log_queue = queue.SimpleQueue()
+        handler = LogQueueHandler(log_queue)
+        _log_listener = logging.handlers.QueueListener(log_queue, output)
+        _log_listener.start()
+        atexit.register(_log_listener.stop)
+        for name in NOISY_LOGGERS:
+            logging.getLogger(name).setLevel(logging.WARNING)
+    if LOG_SAMPLE_RATE < 1:
+        handler.addFilter(LogSampler(LOG_SAMPLE_RATE))
+    handler.zhenyagpt = True
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+
+_app_initialized = False
+_app_init_lock = threading.Lock()
+
+def create_app():
+    # Вся инициализация с побочными эффектами (логирование, проверка ключа, миграции, прогрев пула)
+    # выполняется здесь, один раз на процесс; импорт модуля ничего не подключает
+    global _app_initialized
+    with _app_init_lock:
+        if not _app_initialized:
+            configure_logging()
+            get_api_key()
+            if AUTO_MIGRATE:
+                migrate()
+            warm_up()
+            _app_initialized = True
+    return app
+
+def create_asgi_app():
+    return ChatASGIApp(create_app())
+
+class ChatASGIApp:
+    # POST / обрабатывается прямо в event loop uvicorn: ожидание ответа модели
+    # не занимает поток. Остальные маршруты идут во Flask в пуле потоков.
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi_executor = ThreadPoolExecutor(max_workers=WSGI_THREADS, thread_name_prefix="wsgi")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] == "http" and scope["method"] == "POST" and scope["path"] == "/":
+            return await self.chat(scope, receive, send)
+        if scope["type"] == "http":
+            return await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                # Для uvicorn app:asgi_app инициализация идёт здесь, а не при импорте
+                try:
+                    await asyncio.get_running_loop().run_in_executor(None, create_app)
+                except Exception as e:
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await close_async_client()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    @staticmethod
+    async def read_body(receive):
+        # Большие тела (импорт истории) уходят во временный файл, а не копятся в памяти
+        body = tempfile.SpooledTemporaryFile(max_size=REQUEST_BODY_SPOOL_BYTES)
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                body.close()
+                return None
+            body.write(message.get("body", b""))
+            if not message.get("more_body"):
+                body.seek(0)
+                return body
+
+    async def wsgi(self, scope, receive, send):
+        body = await self.read_body(receive)
+        if body is None:
+            return
+        loop = asyncio.get_running_loop()
+        environ = self.build_environ(scope, body)
+        # uvicorn молча игнорирует send() после отключения клиента, поэтому отключение
+        # отслеживаем сами, как в chat(), иначе потоковый ответ дочитывался бы до конца впустую
+        disconnected = threading.Event()
+        watcher = asyncio.create_task(self.wait_disconnect(receive))
+        watcher.add_done_callback(lambda task: not task.cancelled() and disconnected.set())
+        try:
+            await loop.run_in_executor(self.wsgi_executor, self.run_wsgi, environ, send, loop, disconnected)
+        finally:
+            watcher.cancel()
+            body.close()
+
+    def run_wsgi(self, environ, send, loop, disconnected=None):
+        # Весь запрос, включая итерацию тела ответа, идёт в одном потоке:
+        # stream_with_context держит контекст Flask в переменных этого потока
+        disconnected = disconnected or threading.Event()
+
+        def send_message(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        response_start = {}
+
+        def start_response(status, headers, exc_info=None):
+            response_start.update({
+                "type": "http.response.start",
+                "status": int(status.split(" ", 1)[0]),
+                "headers": [(name.lower().encode("latin1"), value.encode("latin1")) for name, value in headers],
+            })
+            return lambda data: None
+
+        body = self.flask_app(environ, start_response)
+        try:
+            started = False
+            for chunk in body:
+                if disconnected.is_set():
+                    logger.info("Клиент отключился, прекращаем отдачу ответа")
+                    return
+                if not chunk:
+                    continue
+                if not started:
+                    send_message(response_start)
+                    started = True
+                send_message({"type": "http.response.body", "body": chunk, "more_body": True})
+            if not started:
+                send_message(response_start)
+            send_message({"type": "http.response.body", "body": b""})
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+
+    async def chat(self, scope, receive, send):
+        body = await self.read_body(receive)
+        if body is None:
+            return
+
+        environ = self.build_environ(scope, body)
+        ctx = self.flask_app.request_context(environ)
+        ctx.push()
+        disconnected = asyncio.create_task(self.wait_disconnect(receive))
+        try:
+            rv = self.flask_app.preprocess_request()
+            if rv is not None:
+                response, events = self.flask_app.make_response(rv), None
+            else:
+                response, events = await chat_post()
+            response = self.flask_app.process_response(response)
+            await send({
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": [(name.lower().encode("latin1"), value.encode("latin1"))
+                            for name, value in response.headers.to_wsgi_list()],
+            })
+            if events is None:
+                await send({"type": "http.response.body", "body": response.get_data()})
+                return
+            # Отключение клиента останавливает генерацию, не дожидаясь следующего куска
+            request_id = response.headers.get("X-Request-Id")
+            disconnected.add_done_callback(
+                lambda task: not task.cancelled() and cancel_local_requests(request_id=request_id))
+            try:
+                async for event in events:
+                    if disconnected.done():
+                        logger.info("Клиент отключился, прекращаем стрим")
+                        break
+                    await send({"type": "http.response.body", "body": ndjson_event(event).encode("utf-8"), "more_body": True})
+            finally:
+                await events.aclose()
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            disconnected.cancel()
+            ctx.pop()
+            body.close()
+
+    @staticmethod
+    def build_environ(scope, body):
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin1"),
+            "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+            "QUERY_STRING": scope["query_string"].decode("ascii"),
+            "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": body,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False,
+        }
+        server = scope.get("server") or ("localhost", 80)
+        environ["SERVER_NAME"], environ["SERVER_PORT"] = server[0], str(server[1] or 0)
+        if scope.get("client"):
+            environ["REMOTE_ADDR"], environ["REMOTE_PORT"] = scope["client"][0], str(scope["client"][1])
+        for name, value in scope.get("headers", []):
+            name = name.decode("latin1").upper().replace("-", "_")
+            key = name if name in ("CONTENT_TYPE", "CONTENT_LENGTH") else f"HTTP_{name}"
+            value = value.decode("latin1")
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    @staticmethod
+    async def wait_disconnect(receive):
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+asgi_app = ChatASGIApp(app)
 
 if __name__ == "__main__":
+    if sys.argv[1:] == ["migrate"]:
+        configure_logging()
+        migrate()
+        sys.exit(0)
+    if sys.argv[1:] == ["warmup"]:
+        configure_logging()
+        sys.exit(1 if warm_up() else 0)
     import uvicorn
+    configure_logging()
     port = int(os.environ.get("PORT", 5000))
-    uvicorn.run("app:asgi_app", host="0.0.0.0", port=port, log_level="debug")
+    # В production-режиме логи uvicorn идут через наши обработчики (JSON, очередь, выборка)
+    uvicorn.run("app:asgi_app", host="0.0.0.0", port=port, log_level=LOG_LEVEL.lower(),
+                **({"log_config": None} if PRODUCTION_LOGGING else {}))
@@ -0,0 +1,143 @@
+# Локальная замена OpenRouter для нагрузочных тестов: OpenAI-совместимый
+# /v1/chat/completions с настраиваемой задержкой, скоростью токенов и ошибками.
+#
+#   python bench/fake_openrouter.py --port 8765 --latency 0.3 --token-rate 50 --error-rate 0.05
+#
+# Приложение направляется на него через OPENROUTER_BASE_URL=http://127.0.0.1:8765/v1
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+from aiohttp import web
+
+WORDS = ("Женя", "сделал", "меня", "лучше", "всех", "и", "это", "очевидно", "ответ", "на", "твой",
+         "вопрос", "вот", "такой", "код", "работает", "быстро", "но", "не", "всегда")
+
+
+def make_chunk(completion_id, model, delta, finish_reason=None):
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+def make_completion(completion_id, model, content, completion_tokens):
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 0, "completion_tokens": completion_tokens, "total_tokens": completion_tokens},
+    }
+
+
+class FakeOpenRouter:
+    def __init__(self, latency, jitter, token_rate, tokens, error_rate, rate_limit_rate, seed=None,
+                 model_latency=None, model_error_rate=None):
+        self.latency = latency
+        self.model_latency = model_latency or {}
+        self.model_error_rate = model_error_rate or {}
+        self.jitter = jitter
+        self.token_rate = token_rate
+        self.tokens = tokens
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.in_flight = 0
+        self.errors = 0
+
+    def injected_error(self, model):
+        roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            return web.json_response({"error": {"message": "Rate limit exceeded", "code": 429}},
+                                     status=429, headers={"Retry-After": "1"})
+        if roll < self.rate_limit_rate + self.model_error_rate.get(model, self.error_rate):
+            return web.json_response({"error": {"message": "Upstream error", "code": 502}}, status=502)
+        return None
+
+    def reply_tokens(self, max_tokens):
+        count = min(self.tokens, max_tokens or self.tokens)
+        return [self.random.choice(WORDS) + " " for _ in range(count)]
+
+    async def completions(self, request):
+        self.requests += 1
+        self.in_flight += 1
+        try:
+            body = await request.json()
+            model = body.get("model", "fake/model")
+            latency = self.model_latency.get(model, self.latency)
+            await asyncio.sleep(max(0.0, latency + self.random.uniform(-self.jitter, self.jitter)))
+            error = self.injected_error(model)
+            if error is not None:
+                self.errors += 1
+                return error
+
+            completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+            tokens = self.reply_tokens(body.get("max_tokens"))
+            if not body.get("stream"):
+                return web.json_response(make_completion(completion_id, model, "".join(tokens), len(tokens)))
+
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+            await response.prepare(request)
+            delay = 1.0 / self.token_rate if self.token_rate > 0 else 0
+            await response.write(f"data: {json.dumps(make_chunk(completion_id, model, {'role': 'assistant'}))}\n\n".encode())
+            for token in tokens:
+                await response.write(f"data: {json.dumps(make_chunk(completion_id, model, {'content': token}), ensure_ascii=False)}\n\n".encode())
+                if delay:
+                    await asyncio.sleep(delay)
+            await response.write(f"data: {json.dumps(make_chunk(completion_id, model, {}, 'stop'))}\n\n".encode())
+            await response.write(b"data: [DONE]\n\n")
+            return response
+        finally:
+            self.in_flight -= 1
+
+    async def stats(self, request):
+        return web.json_response({"requests": self.requests, "in_flight": self.in_flight, "errors": self.errors})
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.completions)
+        app.router.add_get("/stats", self.stats)
+        return app
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Локальный OpenAI-совместимый сервер для бенчмарков")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.3, help="задержка до первого токена, секунды")
+    parser.add_argument("--jitter", type=float, default=0.05, help="разброс задержки, секунды")
+    parser.add_argument("--token-rate", type=float, default=50, help="токенов в секунду при стриминге")
+    parser.add_argument("--tokens", type=int, default=60, help="длина ответа в токенах")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 502")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--model-latency", action="append", default=[], metavar="МОДЕЛЬ=СЕКУНДЫ",
+                        help="задержка для отдельной модели (можно повторять)")
+    parser.add_argument("--model-error-rate", action="append", default=[], metavar="МОДЕЛЬ=ДОЛЯ",
+                        help="доля ответов 502 для отдельной модели (можно повторять)")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args(argv)
+
+
+def parse_overrides(items):
+    overrides = {}
+    for item in items:
+        model, _, value = item.rpartition("=")
+        overrides[model] = float(value)
+    return overrides
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    server = FakeOpenRouter(args.latency, args.jitter, args.token_rate, args.tokens,
+                            args.error_rate, args.rate_limit_rate, args.seed,
+                            parse_overrides(args.model_latency), parse_overrides(args.model_error_rate))
+    web.run_app(server.make_app(), host=args.host, port=args.port, print=None)
@@ -0,0 +1,299 @@
+# Нагрузочный тест горячих путей. Поднимает fake_openrouter, временную базу
+# в Postgres и приложение под uvicorn, затем гоняет реальные маршруты
+# (/register, /login, POST /, /new_chat, /switch_chat) конкурентными пользователями.
+#
+#   BENCH_DATABASE_URL=postgresql://postgres@localhost/postgres \
+#       python bench/loadtest.py --users 50 --turns 5 --json bench_output.json
+#
+# BENCH_DATABASE_URL — строка подключения с правом CREATE DATABASE; временная база
+# создаётся рядом и удаляется после прогона. С --baseline отчёт сравнивается
+# с сохранённым ранее, и при росте p95 больше --max-regression код выхода ненулевой.
+import argparse
+import asyncio
+import collections
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+
+import aiohttp
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, make_dsn
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROMPTS = ("привет", "кто тебя создал?", "напиши функцию сортировки на python",
+           "объясни разницу между TCP и UDP", "как дела?", "придумай название для стартапа")
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.ttft = []
+
+    def record(self, route, seconds, ok):
+        self.latencies[route].append(seconds)
+        if not ok:
+            self.errors[route] += 1
+
+    @property
+    def total_requests(self):
+        return sum(len(values) for values in self.latencies.values())
+
+
+@contextmanager
+def throwaway_database(admin_dsn):
+    name = f"zhenyagpt_bench_{uuid.uuid4().hex[:8]}"
+    conn = psycopg2.connect(admin_dsn)
+    conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    with conn.cursor() as c:
+        c.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(name)))
+    try:
+        yield make_dsn(admin_dsn, dbname=name)
+    finally:
+        with conn.cursor() as c:
+            c.execute(sql.SQL("DROP DATABASE IF EXISTS {} WITH (FORCE)").format(sql.Identifier(name)))
+        conn.close()
+
+
+def start_process(args, log, env=None):
+    return subprocess.Popen(args, cwd=ROOT, env={**os.environ, **(env or {})}, stdout=log, stderr=subprocess.STDOUT)
+
+
+def stop_process(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+async def wait_http(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as http:
+        while time.monotonic() < deadline:
+            try:
+                async with http.get(url, allow_redirects=False) as resp:
+                    await resp.read()
+                    return
+            except aiohttp.ClientError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} не ответил за {timeout} секунд")
+
+
+async def timed_request(http, recorder, route, method, url, **kwargs):
+    start = time.perf_counter()
+    ok = False
+    try:
+        async with http.request(method, url, allow_redirects=False, **kwargs) as resp:
+            await resp.read()
+            ok = resp.status < 400
+    except aiohttp.ClientError:
+        pass
+    recorder.record(route, time.perf_counter() - start, ok)
+
+
+async def chat_turn(http, recorder, base_url, prompt):
+    # Стриминговый POST /: время до первого куска и до конца ответа
+    start = time.perf_counter()
+    first_token = None
+    ok = False
+    chat_ids = []
+    try:
+        async with http.post(f"{base_url}/", data={"user_input": prompt, "stream": "1"},
+                             headers={"Accept": "application/x-ndjson"}) as resp:
+            ok = resp.status == 200
+            async for line in resp.content:
+                if not line.strip():
+                    continue
+                event = json.loads(line)
+                if event["type"] in ("delta", "error") and first_token is None:
+                    first_token = time.perf_counter()
+                if event["type"] == "error":
+                    ok = False
+                elif event["type"] == "done":
+                    chat_ids = list(event["chats"])
+    except (aiohttp.ClientError, ValueError):
+        ok = False
+    recorder.record("POST /", time.perf_counter() - start, ok)
+    if first_token is not None:
+        recorder.ttft.append(first_token - start)
+    return chat_ids
+
+
+async def simulate_user(base_url, index, args, recorder, rng):
+    async with aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True)) as http:
+        credentials = {"username": f"bench_{index}_{uuid.uuid4().hex[:6]}", "password": "bench-password"}
+        await timed_request(http, recorder, "POST /register", "POST", f"{base_url}/register", data=credentials)
+        await timed_request(http, recorder, "POST /login", "POST", f"{base_url}/login", data=credentials)
+        await timed_request(http, recorder, "GET /", "GET", f"{base_url}/")
+
+        chat_ids = []
+        for turn in range(args.turns):
+            if turn and args.new_chat_every and turn % args.new_chat_every == 0:
+                await timed_request(http, recorder, "GET /new_chat", "GET", f"{base_url}/new_chat")
+                await timed_request(http, recorder, "GET /", "GET", f"{base_url}/")
+            elif len(chat_ids) > 1 and rng.random() < args.switch_rate:
+                chat_id = rng.choice(chat_ids)
+                await timed_request(http, recorder, "GET /switch_chat", "GET", f"{base_url}/switch_chat/{chat_id}")
+                await timed_request(http, recorder, "GET /", "GET", f"{base_url}/")
+            chat_ids = await chat_turn(http, recorder, base_url, rng.choice(PROMPTS)) or chat_ids
+            if args.think_time:
+                await asyncio.sleep(rng.uniform(0, args.think_time))
+
+
+async def fetch_json(url):
+    async with aiohttp.ClientSession() as http:
+        async with http.get(url) as resp:
+            return await resp.json()
+
+
+async def run_scenario(base_url, args):
+    recorder = Recorder()
+    rng = random.Random(args.seed)
+    db_before = await fetch_json(f"{base_url}/db_stats")
+    started = time.perf_counter()
+    await asyncio.gather(*(simulate_user(base_url, i, args, recorder, random.Random(rng.random()))
+                           for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+    db_after = await fetch_json(f"{base_url}/db_stats")
+    return build_report(recorder, elapsed, db_after["queries"] - db_before["queries"])
+
+
+def build_report(recorder, elapsed, db_queries):
+    def summary(values):
+        return {f"p{q}_ms": round(percentile(values, q) * 1000, 1) for q in (50, 95, 99)} if values else {}
+
+    routes = {route: {"requests": len(values), "errors": recorder.errors[route], **summary(values)}
+              for route, values in sorted(recorder.latencies.items())}
+    total = recorder.total_requests
+    return {
+        "duration_s": round(elapsed, 2),
+        "requests": total,
+        "throughput_rps": round(total / elapsed, 2) if elapsed else 0,
+        "routes": routes,
+        "ttft": summary(recorder.ttft),
+        "db_queries": db_queries,
+        "db_queries_per_request": round(db_queries / total, 2) if total else 0,
+    }
+
+
+def print_report(report):
+    print(f"{'Маршрут':<20}{'Запросов':>10}{'Ошибок':>8}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}")
+    for route, stats in report["routes"].items():
+        print(f"{route:<20}{stats['requests']:>10}{stats['errors']:>8}"
+              f"{stats.get('p50_ms', '-'):>10}{stats.get('p95_ms', '-'):>10}{stats.get('p99_ms', '-'):>10}")
+    ttft = report["ttft"]
+    print(f"\nПропускная способность: {report['throughput_rps']} запросов/с "
+          f"({report['requests']} запросов за {report['duration_s']} с)")
+    if ttft:
+        print(f"Время до первого токена: p50 {ttft['p50_ms']} мс, p95 {ttft['p95_ms']} мс, p99 {ttft['p99_ms']} мс")
+    print(f"Запросов к БД на HTTP-запрос: {report['db_queries_per_request']} (всего {report['db_queries']})")
+
+
+def find_regressions(report, baseline, max_regression):
+    regressions = []
+    pairs = [(f"{route} p95", stats.get("p95_ms"), baseline["routes"].get(route, {}).get("p95_ms"))
+             for route, stats in report["routes"].items()]
+    pairs.append(("TTFT p95", report["ttft"].get("p95_ms"), baseline.get("ttft", {}).get("p95_ms")))
+    pairs.append(("DB queries/request", report["db_queries_per_request"], baseline.get("db_queries_per_request")))
+    for name, current, previous in pairs:
+        if current is not None and previous and current > previous * (1 + max_regression):
+            regressions.append(f"{name}: {previous} -> {current}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест ZhenyaGPT с локальной заменой OpenRouter")
+    parser.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL"),
+                        help="Postgres с правом CREATE DATABASE (по умолчанию BENCH_DATABASE_URL)")
+    parser.add_argument("--app-url", help="уже запущенное приложение; тогда сервер и база не поднимаются")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=5, help="сообщений на пользователя")
+    parser.add_argument("--new-chat-every", type=int, default=3, help="новый чат каждые N сообщений (0 — никогда)")
+    parser.add_argument("--switch-rate", type=float, default=0.2, help="вероятность переключить чат перед сообщением")
+    parser.add_argument("--think-time", type=float, default=0.0, help="пауза между сообщениями, секунды (макс.)")
+    parser.add_argument("--workers", type=int, default=1, help="воркеров uvicorn (статистика БД точна только для 1)")
+    parser.add_argument("--app-port", type=int, default=8790)
+    parser.add_argument("--fake-port", type=int, default=8791)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--token-rate", type=float, default=50)
+    parser.add_argument("--tokens", type=int, default=60)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="сохранить отчёт в JSON")
+    parser.add_argument("--baseline", help="JSON-отчёт предыдущего прогона для сравнения")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="допустимый рост p95, доля")
+    return parser.parse_args(argv)
+
+
+def run_with_local_stack(args):
+    if not args.database_url:
+        raise SystemExit("Нужен --database-url или BENCH_DATABASE_URL")
+    log = tempfile.NamedTemporaryFile(prefix="zhenyagpt_bench_", suffix=".log", delete=False)
+    fake = start_process([sys.executable, os.path.join("bench", "fake_openrouter.py"),
+                          "--port", str(args.fake_port), "--latency", str(args.latency),
+                          "--token-rate", str(args.token_rate), "--tokens", str(args.tokens),
+                          "--error-rate", str(args.error_rate), "--rate-limit-rate", str(args.rate_limit_rate),
+                          "--seed", str(args.seed)], log)
+    try:
+        with throwaway_database(args.database_url) as dsn:
+            app = start_process([sys.executable, "-m", "uvicorn", "app:asgi_app", "--port", str(args.app_port),
+                                 "--workers", str(args.workers), "--log-level", "warning"], log, env={
+                "DATABASE_URL": dsn,
+                "OPENROUTER_API_KEY": "bench-key-not-used",
+                "OPENROUTER_BASE_URL": f"http://127.0.0.1:{args.fake_port}/v1",
+                "SECRET_KEY": "bench-secret",
+            })
+            try:
+                base_url = f"http://127.0.0.1:{args.app_port}"
+                asyncio.run(wait_http(f"{base_url}/login"))
+                return asyncio.run(run_scenario(base_url, args))
+            finally:
+                stop_process(app)
+    except Exception:
+        print(f"Лог сервера: {log.name}", file=sys.stderr)
+        raise
+    finally:
+        stop_process(fake)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.app_url:
+        report = asyncio.run(run_scenario(args.app_url.rstrip("/"), args))
+    else:
+        report = run_with_local_stack(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = find_regressions(report, json.load(f), args.max_regression)
+        if regressions:
+            print("\nРегрессии относительно базового прогона:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
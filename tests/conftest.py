@@ -0,0 +1,84 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENROUTER_API_KEY", "test-key")
+
+import app as zhenyagpt  # noqa: E402  импорт без побочных эффектов: БД и клиент создаются лениво
+
+
+def messages(*contents):
+    # История чата для контекста: реплики по очереди пользователя и ассистента, id с 1
+    roles = ("user", "assistant")
+    return [{"id": i + 1, "role": roles[i % 2], "content": text} for i, text in enumerate(contents)]
+
+
+class FakeCursor:
+    # Записывает выполненные запросы в соединение; fetchone отдаёт заранее заданную строку
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, vars=None):
+        if self.conn.fail_on and self.conn.fail_on in query:
+            raise zhenyagpt.psycopg2.OperationalError("запрос не выполнен")
+        self.conn.statements.append((query, vars))
+
+    def fetchone(self):
+        return self.conn.next_row
+
+
+class FakeConnection:
+    # Минимум интерфейса psycopg2-соединения, который нужен ConnectionPool и db_cursor
+    def __init__(self):
+        self.closed = 0
+        self.rollbacks = 0
+        self.commits = 0
+        self.statements = []
+        self.next_row = None
+        self.fail_on = None
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def get_transaction_status(self):
+        return 0
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def commit(self):
+        self.commits += 1
+
+    def close(self):
+        self.closed = 1
+
+
+class FakePool(zhenyagpt.ConnectionPool):
+    def __init__(self, maxconn=4, timeout=0.5):
+        super().__init__("fake", 1, maxconn, timeout, healthcheck_interval=3600)
+        self.created = []
+
+    def _connect(self):
+        conn = FakeConnection()
+        self.created.append(conn)
+        return conn
+
+
+@pytest.fixture
+def app_module():
+    return zhenyagpt
+
+
+@pytest.fixture
+def fake_pool(monkeypatch):
+    pool = FakePool()
+    monkeypatch.setattr(zhenyagpt, "db_pool", pool)
+    return pool
@@ -0,0 +1,71 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+
+@pytest.fixture
+def auth_queue(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "auth_slots", threading.BoundedSemaphore(1))
+    monkeypatch.setattr(app_module, "AUTH_QUEUE_TIMEOUT", 5)
+    return app_module
+
+
+def test_overlapping_logins_wait_for_a_slot(auth_queue):
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_hash():
+        started.set()
+        release.wait(5)
+        return "first"
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        first = pool.submit(auth_queue.run_auth, "login", slow_hash)
+        assert started.wait(5)
+        second = pool.submit(auth_queue.run_auth, "login", lambda: "second")
+        release.set()
+        assert first.result(5) == "first"
+        assert second.result(5) == "second"
+
+
+def test_login_rejected_when_queue_wait_expires(auth_queue, monkeypatch):
+    monkeypatch.setattr(auth_queue, "AUTH_QUEUE_TIMEOUT", 0.05)
+    assert auth_queue.auth_slots.acquire(blocking=False)
+    try:
+        with pytest.raises(auth_queue.AuthBusy) as excinfo:
+            auth_queue.run_auth("login", lambda: None)
+    finally:
+        auth_queue.auth_slots.release()
+    assert excinfo.value.retry_after > 0
+
+
+def test_login_attempts_limited_per_username(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "login_buckets", app_module.LoginBuckets(0.001, 2, 16))
+    app_module.take_login_attempt("alice")
+    app_module.take_login_attempt("alice")
+    with pytest.raises(app_module.AuthBusy):
+        app_module.take_login_attempt("alice")
+    app_module.take_login_attempt("bob")
+
+
+def test_junk_usernames_do_not_evict_throttled_bucket(app_module):
+    buckets = app_module.LoginBuckets(0.001, 2, 3)
+    assert buckets.take("alice") == 0
+    assert buckets.take("alice") == 0
+    assert buckets.take("alice") > 0
+    for i in range(100):
+        buckets.take(f"junk{i}")
+    # место занято корзинами, которые ещё не наполнились: новые имена ждут, лимит alice цел
+    assert buckets.take("alice") > 0
+    assert buckets.take("junk-new") > 0
+
+
+def test_refilled_buckets_evicted(app_module, monkeypatch):
+    buckets = app_module.LoginBuckets(1.0, 2, 2)
+    buckets.take("a")
+    buckets.take("b")
+    clock = app_module.time.monotonic() + 10
+    monkeypatch.setattr(app_module.time, "monotonic", lambda: clock)
+    assert buckets.take("c") == 0
+    assert list(buckets._buckets) == ["b", "c"]
@@ -0,0 +1,196 @@
+import asyncio
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def turn(app_module, monkeypatch):
+    # Ход диалога без БД и модели: хелперы БД подменены, модель — управляемый генератор
+    state = {"saved": [], "titles": [], "chunks": ["При", "вет"], "title": "Приветствие",
+             "title_delay": 0.0, "release": None}
+
+    async def fake_stream(messages, style, user_id=None, model=None):
+        for i, chunk in enumerate(state["chunks"]):
+            if state["release"] is not None and i == 1:
+                await state["release"].wait()
+            yield chunk
+
+    async def fake_title(user_input, user_id=None):
+        await asyncio.sleep(state["title_delay"])
+        return state["title"]
+
+    def save_chat_turn(user_id, chat_id, messages, title):
+        state["saved"].append((messages, title))
+
+    monkeypatch.setattr(app_module, "ensure_cancellation_listener", lambda: None)
+    monkeypatch.setattr(app_module, "stream_response_from_api", fake_stream)
+    monkeypatch.setattr(app_module, "generate_chat_title", fake_title)
+    monkeypatch.setattr(app_module, "model_pool", app_module.ModelPool("m"))
+    monkeypatch.setattr(app_module, "RESPONSE_CACHE_STYLES", set())
+    monkeypatch.setattr(app_module, "save_chat_turn", save_chat_turn)
+    monkeypatch.setattr(app_module, "update_chat_title", lambda chat_id, title: state["titles"].append(title))
+    monkeypatch.setattr(app_module, "get_chats_page", lambda user_id: ({"c1": {"title": "Без названия"}}, None))
+
+    def events(user_id=1, first_message=True):
+        context = {"summary": None, "summary_upto": 0,
+                   "messages": [] if first_message else [{"id": 1, "role": "user", "content": "раньше"}]}
+        return app_module.chat_turn_events("r1", user_id, "c1", context, "привет", "formal",
+                                           app_module.RequestTrace("r1"))
+    state["events"] = events
+    return state
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def collect(events, on_event=None):
+    seen = []
+    async for event in events:
+        seen.append(event)
+        if on_event:
+            on_event(event)
+    return seen
+
+
+def test_event_sequence_and_single_save(app_module, turn):
+    events = run(collect(turn["events"](first_message=False)))
+    assert [e["type"] for e in events] == ["start", "delta", "delta", "done"]
+    assert events[0]["request_id"] == "r1"
+    assert "".join(e["content"] for e in events if e["type"] == "delta") == "Привет"
+    assert events[-1]["chats"] == {"c1": {"title": "Без названия"}}
+    assert turn["saved"] == [([("user", "привет", None), ("assistant", "Привет", "m")], None)]
+    assert "r1" not in app_module.active_requests
+
+
+def test_stop_saves_partial_reply(app_module, turn):
+    async def scenario():
+        turn["release"] = asyncio.Event()
+
+        def on_event(event):
+            if event["type"] == "delta":
+                assert app_module.cancel_local_requests(1, "r1") == 1
+        return await collect(turn["events"](first_message=False), on_event)
+
+    events = run(scenario())
+    assert [e["type"] for e in events] == ["start", "delta", "cancelled", "done"]
+    assert turn["saved"] == [([("user", "привет", None), ("assistant", "При", "m")], None)]
+
+
+def test_stop_scoped_to_owner(app_module, turn):
+    async def scenario():
+        turn["release"] = asyncio.Event()
+        stopped = []
+
+        def on_event(event):
+            if event["type"] == "delta" and not stopped:
+                stopped.append(app_module.cancel_local_requests(2, "r1"))
+                turn["release"].set()
+        events = await collect(turn["events"](user_id=1, first_message=False), on_event)
+        return events, stopped
+
+    events, stopped = run(scenario())
+    assert stopped == [0]
+    assert [e["type"] for e in events] == ["start", "delta", "delta", "done"]
+
+
+def test_upstream_error_reported_and_saved(app_module, turn, monkeypatch):
+    async def failing(messages, style, user_id=None, model=None):
+        raise RuntimeError("апстрим недоступен")
+        yield
+
+    monkeypatch.setattr(app_module, "stream_response_from_api", failing)
+    events = run(collect(turn["events"](first_message=False)))
+    assert [e["type"] for e in events] == ["start", "error", "done"]
+    assert turn["saved"][0][0][1] == ("assistant", events[1]["content"], None)
+
+
+def test_ready_title_saved_with_turn(app_module, turn):
+    async def scenario():
+        # название готово раньше ответа: оно уходит событием и пишется той же транзакцией
+        turn["release"] = asyncio.Event()
+        asyncio.get_running_loop().call_later(0.05, turn["release"].set)
+        return await collect(turn["events"]())
+
+    events = run(scenario())
+    types = [e["type"] for e in events]
+    assert types.index("title") < types.index("done")
+    assert turn["saved"][0][1] == "Приветствие"
+    assert turn["titles"] == []
+
+
+def test_slow_title_follows_done(app_module, turn):
+    turn["title_delay"] = 0.1
+    events = run(collect(turn["events"]()))
+    assert [e["type"] for e in events] == ["start", "delta", "delta", "done", "title"]
+    assert turn["saved"][0][1] is None
+    assert turn["titles"] == ["Приветствие"]
+
+
+def test_json_reply_does_not_wait_for_title(app_module, turn):
+    turn["title_delay"] = 5
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        reply, chats = await app_module.collect_chat_reply(turn["events"]())
+        return reply, chats, loop.time() - started
+
+    reply, chats, elapsed = run(scenario())
+    assert reply == "Привет" and chats
+    assert elapsed < 1
+
+
+class ImmediateLoop:
+    def call_soon_threadsafe(self, callback):
+        callback()
+
+
+@pytest.fixture
+def client(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "publish_cancel", lambda user_id, request_id: None)
+    app_module.app.config["TESTING"] = True
+    return app_module.app.test_client()
+
+
+def test_stop_route_only_stops_own_requests(app_module, client, monkeypatch):
+    mine, theirs = threading.Event(), threading.Event()
+    monkeypatch.setitem(app_module.active_requests, "mine", {"user_id": 1, "loop": ImmediateLoop(), "cancel": mine})
+    monkeypatch.setitem(app_module.active_requests, "theirs", {"user_id": 2, "loop": ImmediateLoop(), "cancel": theirs})
+    with client.session_transaction() as session:
+        session["user_id"] = 1
+    assert client.post("/stop_response", data={"request_id": "theirs"}).status_code == 200
+    assert not theirs.is_set()
+    client.post("/stop_response", data={})
+    assert mine.is_set() and not theirs.is_set()
+
+
+@pytest.fixture
+def recorded_values(app_module, monkeypatch):
+    # execute_values собирает VALUES через mogrify настоящего соединения — здесь пишем строки как есть
+    def execute_values(cursor, query, rows):
+        cursor.execute(query, rows)
+    monkeypatch.setattr(app_module.psycopg2.extras, "execute_values", execute_values)
+
+
+def test_turn_saved_in_one_transaction(app_module, fake_pool, recorded_values):
+    conn = fake_pool.getconn()
+    conn.next_row = (1,)
+    fake_pool.putconn(conn)
+    app_module.save_chat_turn(1, "c1", [("user", "привет", None), ("assistant", "Привет", "m")], "Приветствие")
+    queries = [query for query, _ in conn.statements]
+    assert len(queries) == 2 and "INSERT INTO messages" in queries[0] and "UPDATE chats" in queries[1]
+    assert conn.statements[0][1] == [("c1", 1, "user", "привет", None), ("c1", 1, "assistant", "Привет", "m")]
+    assert conn.statements[1][1] == ("Приветствие", "c1")
+    assert (conn.commits, conn.rollbacks) == (1, 0)
+
+
+def test_failed_turn_rolled_back(app_module, fake_pool, recorded_values):
+    conn = fake_pool.getconn()
+    conn.fail_on = "UPDATE chats"
+    fake_pool.putconn(conn)
+    with pytest.raises(app_module.psycopg2.OperationalError):
+        app_module.save_chat_turn(1, "c1", [("user", "привет", None)])
+    assert conn.commits == 0 and conn.rollbacks >= 1
+    assert fake_pool.stats()["in_use"] == 0
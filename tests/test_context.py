@@ -0,0 +1,88 @@
+import asyncio
+
+from conftest import messages
+
+
+def test_token_estimate(app_module):
+    assert app_module.estimate_tokens("") == 0
+    assert app_module.estimate_tokens(None) == 0
+    assert app_module.estimate_tokens("привет, мир!") == 2 + 1 + 1 + 1
+    assert app_module.estimate_message_tokens({"content": "мир"}) == 5
+
+
+def test_whole_context_fits(app_module):
+    context = {"summary": None, "messages": messages("раз", "два")}
+    api_messages, overflow = app_module.build_api_messages(context, "три", "formal")
+    assert api_messages[0] == app_module.STYLES["formal"]
+    assert api_messages[1:] == [{"role": "user", "content": "раз"},
+                                {"role": "assistant", "content": "два"},
+                                {"role": "user", "content": "три"}]
+    assert overflow == []
+
+
+def test_oldest_messages_overflow(app_module, monkeypatch):
+    history = messages(*(f"сообщение {i}" for i in range(10)))
+    system_cost = app_module.estimate_message_tokens(app_module.STYLES["formal"])
+    per_message = app_module.estimate_message_tokens(history[0])
+    monkeypatch.setattr(app_module, "CONTEXT_TOKEN_BUDGET",
+                        system_cost + app_module.estimate_tokens("вопрос") + 3 * per_message)
+    api_messages, overflow = app_module.build_api_messages({"summary": None, "messages": history}, "вопрос", "formal")
+    # в бюджет попадают три последних сообщения в исходном порядке, остальные уходят в сводку
+    assert [m["content"] for m in api_messages[1:-1]] == ["сообщение 7", "сообщение 8", "сообщение 9"]
+    assert overflow == history[:7]
+
+
+def test_packing_stops_at_first_message_over_budget(app_module, monkeypatch):
+    history = messages("короткое", "очень " * 50, "последнее")
+    system_cost = app_module.estimate_message_tokens(app_module.STYLES["formal"])
+    monkeypatch.setattr(app_module, "CONTEXT_TOKEN_BUDGET", system_cost + 30)
+    api_messages, overflow = app_module.build_api_messages({"summary": None, "messages": history}, "?", "formal")
+    # более старое короткое сообщение не перескакивает через длинное, чтобы не рвать диалог
+    assert [m["content"] for m in api_messages[1:-1]] == ["последнее"]
+    assert overflow == history[:2]
+
+
+def test_summary_goes_after_style_prompt(app_module):
+    context = {"summary": "обсуждали погоду", "messages": messages("и что?")}
+    api_messages, overflow = app_module.build_api_messages(context, "дальше", "formal")
+    assert api_messages[1]["role"] == "system" and "обсуждали погоду" in api_messages[1]["content"]
+    assert [m["content"] for m in api_messages[2:]] == ["и что?", "дальше"]
+    assert overflow == []
+
+
+def test_summary_waits_for_min_batch(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "SUMMARY_MIN_BATCH", 4)
+    history = messages(*(f"сообщение {i}" for i in range(10)))
+    context = {"summary": None, "summary_upto": 0, "messages": history}
+    assert app_module.summary_boundary(context, history[:3]) is None
+    assert app_module.summary_boundary(context, history[:4]) == history[4]["id"]
+
+
+def test_full_tail_summarizes_everything_before_window(app_module, monkeypatch):
+    # длинный чат из коротких сообщений: хвост помещается в бюджет целиком, overflow пуст,
+    # но всё, что старше хвоста, иначе навсегда пропало бы из контекста
+    monkeypatch.setattr(app_module, "CONTEXT_TAIL_LIMIT", 40)
+    tail = messages(*(f"да {i}" for i in range(60)))[20:]
+    context = {"summary": None, "summary_upto": 0, "messages": tail}
+    _, overflow = app_module.build_api_messages(context, "ну?", "formal")
+    assert overflow == []
+    assert app_module.summary_boundary(context, overflow) == tail[0]["id"]
+
+
+def test_full_tail_all_overflowing(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "CONTEXT_TAIL_LIMIT", 2)
+    tail = messages("а", "б")
+    assert app_module.summary_boundary({"messages": tail}, tail) == tail[-1]["id"] + 1
+
+
+def test_summary_batch_bounded_by_boundary(app_module, monkeypatch):
+    calls = []
+
+    def fake_batch(chat_id, after_id, before_id):
+        calls.append((after_id, before_id))
+        return []
+
+    monkeypatch.setattr(app_module, "get_messages_to_summarize", fake_batch)
+    context = {"summary": None, "summary_upto": 5, "messages": []}
+    asyncio.run(app_module.update_chat_summary(1, "chat", context, 21))
+    assert calls == [(5, 21)]
@@ -0,0 +1,120 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+
+def test_checkout_and_release_accounting(app_module, fake_pool):
+    first = fake_pool.getconn()
+    second = fake_pool.getconn()
+    assert first is not second
+    assert fake_pool.stats()["in_use"] == 2
+
+    fake_pool.putconn(first)
+    fake_pool.putconn(second)
+    stats = fake_pool.stats()
+    assert (stats["size"], stats["idle"], stats["in_use"]) == (2, 2, 0)
+    assert fake_pool.getconn() in (first, second)
+
+
+def test_getconn_times_out_when_exhausted(app_module):
+    from conftest import FakePool
+    pool = FakePool(maxconn=1, timeout=0.05)
+    conn = pool.getconn()
+    with pytest.raises(app_module.PoolTimeout):
+        pool.getconn()
+    pool.putconn(conn)
+    stats = pool.stats()
+    assert stats["timeouts"] == 1
+    assert stats["in_use"] == 0
+
+
+def test_discarded_connection_frees_slot(app_module, fake_pool):
+    conn = fake_pool.getconn()
+    fake_pool.putconn(conn, discard=True)
+    stats = fake_pool.stats()
+    assert (stats["size"], stats["idle"], stats["in_use"], stats["discarded"]) == (0, 0, 0, 1)
+    assert conn.closed
+
+
+def test_warm_opens_minconn_connections(app_module):
+    from conftest import FakePool
+    pool = FakePool(maxconn=4)
+    pool.minconn = 3
+    pool.warm()
+    stats = pool.stats()
+    assert (stats["size"], stats["idle"], stats["in_use"]) == (3, 3, 0)
+
+
+def test_closed_idle_connection_replaced(app_module, fake_pool):
+    conn = fake_pool.getconn()
+    fake_pool.putconn(conn)
+    conn.closed = 1
+    fresh = fake_pool.getconn()
+    assert fresh is not conn
+    stats = fake_pool.stats()
+    assert (stats["size"], stats["in_use"], stats["discarded"]) == (1, 1, 1)
+
+
+def test_failed_connect_does_not_leak_slot(app_module, fake_pool, monkeypatch):
+    def refuse():
+        raise RuntimeError("база недоступна")
+    monkeypatch.setattr(fake_pool, "_connect", refuse)
+    with pytest.raises(RuntimeError):
+        fake_pool.getconn()
+    stats = fake_pool.stats()
+    assert (stats["size"], stats["in_use"]) == (0, 0)
+
+
+def test_waiter_gets_released_connection(app_module):
+    from conftest import FakePool
+    pool = FakePool(maxconn=1, timeout=5)
+    conn = pool.getconn()
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.getconn()))
+    waiter.start()
+    deadline = time.monotonic() + 5
+    while pool.stats()["waits"] == 0:
+        assert time.monotonic() < deadline, "getconn не начал ждать соединения"
+        time.sleep(0.001)
+    pool.putconn(conn)
+    waiter.join(5)
+    assert not waiter.is_alive()
+    assert got == [conn]
+    assert pool.stats()["timeouts"] == 0
+
+
+def test_request_reuses_one_connection(app_module, fake_pool):
+    with app_module.app.test_request_context("/"):
+        first = app_module.get_db_connection()
+        app_module.release_db_connection(first)
+        assert app_module.get_db_connection() is first
+        assert fake_pool.stats()["in_use"] == 1
+    # teardown контекста возвращает соединение запроса
+    assert fake_pool.stats()["in_use"] == 0
+
+
+def test_overlapping_run_db_calls_use_separate_connections(app_module, fake_pool):
+    barrier = threading.Barrier(2, timeout=5)
+
+    def helper():
+        conn = app_module.get_db_connection()
+        try:
+            barrier.wait()
+            return conn
+        finally:
+            app_module.release_db_connection(conn)
+
+    async def turn():
+        return await asyncio.gather(app_module.run_db(helper), app_module.run_db(helper))
+
+    with app_module.app.test_request_context("/"):
+        first, second = asyncio.run(turn())
+        assert first is not second
+        assert app_module.g.get("_db_conn") is None
+
+    stats = fake_pool.stats()
+    assert (stats["size"], stats["idle"], stats["in_use"]) == (2, 2, 0)
+    idle = [conn for conn, _ in fake_pool._idle]
+    assert len(idle) == len(set(map(id, idle)))
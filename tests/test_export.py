@@ -0,0 +1,76 @@
+import asyncio
+import threading
+
+import pytest
+from flask import Flask, Response
+
+
+def test_disconnect_stops_streaming_response(app_module):
+    produced = []
+    closed = threading.Event()
+
+    def endless():
+        try:
+            for i in range(10000):
+                produced.append(i)
+                yield b"x" * 10
+        finally:
+            closed.set()
+
+    flask_app = Flask("stream")
+    flask_app.add_url_rule("/", "stream", lambda: Response(endless()))
+    asgi = app_module.ChatASGIApp(flask_app)
+
+    async def scenario():
+        sent = []
+        disconnect = asyncio.Event()
+        messages = [{"type": "http.request", "body": b""}]
+
+        async def receive():
+            if messages:
+                return messages.pop()
+            await disconnect.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+            if len(sent) == 3:
+                disconnect.set()
+            # как uvicorn: после отключения send() ничего не делает и не падает
+            await asyncio.sleep(0.001)
+
+        scope = {"type": "http", "method": "GET", "path": "/", "query_string": b"",
+                 "http_version": "1.1", "headers": []}
+        await asyncio.wait_for(asgi.wsgi(scope, receive, send), 5)
+        return sent
+
+    sent = asyncio.run(scenario())
+    assert closed.is_set()
+    assert len(produced) < 10000
+    assert sent[-1].get("more_body", False) is True
+
+
+@pytest.fixture
+def client(app_module):
+    app_module.app.config["TESTING"] = True
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = 1
+    return client
+
+
+def test_concurrent_exports_limited(app_module, client, monkeypatch):
+    monkeypatch.setattr(app_module, "export_slots", threading.BoundedSemaphore(1))
+    monkeypatch.setattr(app_module, "iter_export_rows", lambda user_id, chat_id=None: iter(()))
+    assert app_module.export_slots.acquire(blocking=False)
+    response = client.get("/export")
+    assert response.status_code == 429
+    assert response.headers["Retry-After"]
+    app_module.export_slots.release()
+
+    response = client.get("/export")
+    assert response.status_code == 200
+    response.close()
+    # слот вернулся после закрытия ответа
+    assert app_module.export_slots.acquire(blocking=False)
+    app_module.export_slots.release()
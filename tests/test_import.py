@@ -0,0 +1,80 @@
+import io
+import json
+
+import psycopg2
+import pytest
+
+
+def jsonl(*records):
+    return io.BytesIO("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records).encode("utf-8"))
+
+
+def test_records_are_numbered_and_blank_lines_skipped(app_module):
+    stream = io.BytesIO(b'{"type": "chat", "id": "a"}\n\n{"type": "message"}\n')
+    assert [number for number, _ in app_module.iter_import_records(stream)] == [1, 3]
+    # поток проходится повторно, как во втором проходе импорта
+    assert len(list(app_module.iter_import_records(stream))) == 2
+
+
+@pytest.mark.parametrize("data, error", [
+    (b'{"type": "chat"\n', "Строка 1: некорректный JSON"),
+    (b'[1, 2]\n', "Строка 1: ожидался объект"),
+    (b'\xff\xfe\n', "UTF-8"),
+])
+def test_malformed_files_rejected(app_module, data, error):
+    with pytest.raises(ValueError, match=error):
+        list(app_module.iter_import_records(io.BytesIO(data)))
+
+
+def test_valid_message(app_module):
+    record = {"chat_id": "a", "role": "assistant", "content": "привет", "model": "m"}
+    assert app_module.validate_import_message(record, 2, {"a"}) == ("assistant", "привет", "m")
+    record["model"] = 5
+    assert app_module.validate_import_message(record, 2, {"a"})[2] is None
+
+
+@pytest.mark.parametrize("record, error", [
+    ({"chat_id": "b", "role": "user", "content": "x"}, "не объявлен"),
+    ({"chat_id": "a", "role": "system", "content": "x"}, "неизвестная роль"),
+    ({"chat_id": "a", "role": "user", "content": None}, "нет текста"),
+    ({"chat_id": "a", "role": "user", "content": "a\u0000b"}, "нулевой символ"),
+])
+def test_invalid_messages_rejected(app_module, record, error):
+    with pytest.raises(ValueError, match=error):
+        app_module.validate_import_message(record, 7, {"a"})
+
+
+def test_timestamps(app_module):
+    assert app_module.parse_import_timestamp("2024-01-02T03:04:05", 1) == "2024-01-02T03:04:05"
+    with pytest.raises(ValueError, match="Строка 4: некорректная дата"):
+        app_module.parse_import_timestamp("вчера", 4)
+
+
+def test_nul_in_title_rejected_before_copy(app_module, fake_pool):
+    stream = jsonl({"type": "chat", "id": "a", "title": "x\u0000y"})
+    with pytest.raises(ValueError, match="нулевой символ"):
+        app_module.import_chats(1, stream)
+    assert fake_pool.stats()["in_use"] == 0
+
+
+@pytest.fixture
+def client(app_module):
+    app_module.app.config["TESTING"] = True
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = 1
+    return client
+
+
+@pytest.mark.parametrize("exc, status", [
+    (ValueError("Строка 1: некорректный JSON"), 400),
+    (psycopg2.DataError("invalid byte sequence"), 400),
+    (psycopg2.OperationalError("connection lost"), 500),
+])
+def test_import_errors_returned_as_json(app_module, client, monkeypatch, exc, status):
+    def failing_import(user_id, stream):
+        raise exc
+    monkeypatch.setattr(app_module, "import_chats", failing_import)
+    response = client.post("/import", data={"file": (io.BytesIO(b"{}\n"), "chats.jsonl")})
+    assert response.status_code == status
+    assert "error" in response.get_json()
@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+
+def test_models_parsed_with_costs(app_module):
+    pool = app_module.ModelPool("fast=2, cheap=0.5 ,plain")
+    assert [(m.name, m.cost) for m in pool.models] == [("fast", 2.0), ("cheap", 0.5), ("plain", 0.0)]
+    assert pool.ranked() == ["fast", "cheap", "plain"]
+    assert pool.title_model() == "plain"
+
+
+def test_unhealthy_and_slow_models_ranked_last(app_module):
+    pool = app_module.ModelPool("a,b,c")
+    for _ in range(5):
+        pool.get("a").record(0.1, False)
+        pool.get("b").record(2.0, True)
+        pool.get("c").record(0.5, True)
+    assert pool.ranked() == ["c", "b", "a"]
+    assert pool.chat_model() == "c"
+
+
+def test_old_samples_forgotten(app_module, monkeypatch):
+    pool = app_module.ModelPool("a,b")
+    for _ in range(5):
+        pool.get("a").record(0.1, False)
+    assert pool.chat_model() == "b"
+    monkeypatch.setattr(app_module, "LLM_HEALTH_TTL", -1)
+    assert pool.chat_model() == "a"
+
+
+@pytest.fixture
+def fake_models(app_module, monkeypatch):
+    # Поведение моделей: ("fail",) — ошибка до первого токена, (задержка, куски) — стрим
+    behaviour = {}
+    closed = []
+
+    async def fake_stream(messages, style, user_id=None, model=None):
+        try:
+            action = behaviour[model]
+            if action[0] == "fail":
+                raise RuntimeError(f"{model} down")
+            await asyncio.sleep(action[0])
+            for part in action[1]:
+                yield part
+        finally:
+            closed.append(model)
+
+    monkeypatch.setattr(app_module, "stream_response_from_api", fake_stream)
+
+    def use(spec, **models):
+        monkeypatch.setattr(app_module, "model_pool", app_module.ModelPool(spec))
+        behaviour.update(models)
+        return closed
+    return use
+
+
+def collect(app_module):
+    async def run():
+        return [pair async for pair in app_module.hedged_stream([], "formal")]
+    return asyncio.run(run())
+
+
+def test_failover_before_first_token(app_module, fake_models):
+    fake_models("a,b", a=("fail",), b=(0, ["при", "вет"]))
+    assert collect(app_module) == [("b", "при"), ("b", "вет")]
+
+
+def test_all_models_failing_raises_last_error(app_module, fake_models):
+    fake_models("a,b", a=("fail",), b=("fail",))
+    with pytest.raises(RuntimeError, match="b down"):
+        collect(app_module)
+
+
+def test_slow_model_hedged_and_loser_closed(app_module, fake_models, monkeypatch):
+    monkeypatch.setattr(app_module, "LLM_HEDGE_AFTER", 0.05)
+    closed = fake_models("a,b", a=(5, ["медленно"]), b=(0, ["быстро"]))
+    assert collect(app_module) == [("b", "быстро")]
+    assert sorted(closed) == ["a", "b"]
+
+
+def test_busy_scheduler_does_not_fail_over(app_module, monkeypatch):
+    started = []
+
+    async def busy_stream(messages, style, user_id=None, model=None):
+        started.append(model)
+        raise app_module.UpstreamBusy("занято", 1)
+        yield
+
+    monkeypatch.setattr(app_module, "stream_response_from_api", busy_stream)
+    monkeypatch.setattr(app_module, "model_pool", app_module.ModelPool("a,b"))
+    with pytest.raises(app_module.UpstreamBusy):
+        collect(app_module)
+    assert started == ["a"]
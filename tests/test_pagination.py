@@ -0,0 +1,54 @@
+import datetime
+
+import pytest
+
+
+def test_cursor_round_trip(app_module):
+    timestamp = datetime.datetime(2024, 5, 6, 7, 8, 9, 123456)
+    cursor = app_module.encode_cursor(timestamp, "3f2c-chat")
+    assert "|" not in cursor and "/" not in cursor
+    assert app_module.decode_cursor(cursor) == (timestamp, "3f2c-chat")
+
+
+def test_cursor_keeps_numeric_ids_as_text(app_module):
+    timestamp = datetime.datetime(2024, 1, 1)
+    assert app_module.decode_cursor(app_module.encode_cursor(timestamp, 42)) == (timestamp, "42")
+
+
+@pytest.mark.parametrize("cursor", ["", "не base64!", "bm9waXBl", "MjAyNC0wMS0wMXwxfDI=", "eHx5"])
+def test_invalid_cursor_rejected(app_module, cursor):
+    with pytest.raises(ValueError, match="Некорректный курсор"):
+        app_module.decode_cursor(cursor)
+
+
+@pytest.fixture
+def client(app_module):
+    app_module.app.config["TESTING"] = True
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = 1
+    return client
+
+
+@pytest.mark.parametrize("raw, expected", [("-1", 1), ("0", 1), ("5", 5), ("1000", 100)])
+def test_page_limit_clamped(app_module, client, monkeypatch, raw, expected):
+    limits = []
+
+    def fake_page(user_id, before=None, limit=None):
+        limits.append(limit)
+        return {}, None
+
+    monkeypatch.setattr(app_module, "get_chats_page", fake_page)
+    assert client.get(f"/chats?limit={raw}").status_code == 200
+    assert limits == [expected]
+
+
+def test_non_numeric_limit_rejected(app_module, client):
+    response = client.get("/chats?limit=много")
+    assert response.status_code == 400
+    assert "limit" in response.get_json()["error"]
+
+
+def test_migration_versions_sequential(app_module):
+    versions = [version for version, _, _ in app_module.MIGRATIONS]
+    assert versions == list(range(1, len(versions) + 1))
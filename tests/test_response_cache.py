@@ -0,0 +1,42 @@
+import pytest
+
+from conftest import messages
+
+
+@pytest.fixture
+def cached_style(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "RESPONSE_CACHE_STYLES", {"sassy"})
+    monkeypatch.setattr(app_module, "RESPONSE_CACHE_HISTORY", 2)
+    return "sassy"
+
+
+def test_first_messages_are_cacheable(app_module, cached_style):
+    context = {"summary": None, "summary_upto": 0, "messages": messages("привет", "здравствуй")}
+    api_messages, _ = app_module.build_api_messages(context, "как дела?", cached_style)
+    history = app_module.cacheable_reply_history(cached_style, context, api_messages)
+    assert [m["content"] for m in history] == ["привет", "здравствуй"]
+
+
+def test_longer_context_is_not_cached(app_module, cached_style):
+    context = {"summary": None, "summary_upto": 0, "messages": messages("секрет", "ответ", "привет", "здравствуй")}
+    api_messages, _ = app_module.build_api_messages(context, "как дела?", cached_style)
+    assert app_module.cacheable_reply_history(cached_style, context, api_messages) is None
+
+
+def test_context_with_summary_is_not_cached(app_module, cached_style):
+    context = {"summary": "пользователь рассказал секрет", "summary_upto": 10, "messages": []}
+    api_messages, _ = app_module.build_api_messages(context, "как дела?", cached_style)
+    assert app_module.cacheable_reply_history(cached_style, context, api_messages) is None
+
+
+def test_style_without_cache_is_not_cached(app_module, cached_style):
+    context = {"summary": None, "summary_upto": 0, "messages": []}
+    api_messages, _ = app_module.build_api_messages(context, "как дела?", "formal")
+    assert app_module.cacheable_reply_history("formal", context, api_messages) is None
+
+
+def test_key_ignores_case_and_whitespace(app_module):
+    first = app_module.response_cache_key("reply", "m", "prompt", [], "Как  дела?")
+    second = app_module.response_cache_key("reply", "m", "prompt", [], "как дела?")
+    assert first == second
+    assert first != app_module.response_cache_key("reply", "other", "prompt", [], "как дела?")
@@ -0,0 +1,150 @@
+import asyncio
+
+import pytest
+
+
+def scheduler(app_module, max_concurrency=1, queue_max=10, user_rate=100.0, user_burst=100.0):
+    return app_module.LLMScheduler(max_concurrency, queue_max, user_rate, user_burst)
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_waiters_served_round_robin_between_users(app_module):
+    async def scenario():
+        sched = scheduler(app_module)
+        order = []
+        release = asyncio.Event()
+
+        async def turn(key, label, hold=None):
+            async with sched.slot(key, "reply"):
+                order.append(label)
+                if hold:
+                    await hold.wait()
+
+        first = asyncio.create_task(turn("a", "a0", release))
+        await settle()
+        # у «a» пачка запросов, «b» пришёл позже, но не ждёт, пока пройдут все запросы «a»
+        tasks = [asyncio.create_task(turn("a", f"a{i}")) for i in (1, 2, 3)]
+        await settle()
+        tasks.append(asyncio.create_task(turn("b", "b1")))
+        await settle()
+        assert sched.waiting == 4
+        release.set()
+        await asyncio.gather(first, *tasks)
+        return order, sched
+
+    order, sched = asyncio.run(scenario())
+    assert order == ["a0", "a1", "b1", "a2", "a3"]
+    assert sched.running == 0 and sched.waiting == 0 and not sched.queues
+
+
+def test_cancelled_waiter_leaves_the_queue(app_module):
+    async def scenario():
+        sched = scheduler(app_module)
+        release = asyncio.Event()
+        served = []
+
+        async def turn(key, hold=None):
+            async with sched.slot(key, "reply"):
+                served.append(key)
+                if hold:
+                    await hold.wait()
+
+        first = asyncio.create_task(turn("a", release))
+        await settle()
+        cancelled = asyncio.create_task(turn("b"))
+        waiting = asyncio.create_task(turn("c"))
+        await settle()
+        cancelled.cancel()
+        await settle()
+        assert sched.waiting == 1 and "b" not in sched.queues
+        release.set()
+        await asyncio.gather(first, waiting)
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        return served, sched
+
+    served, sched = asyncio.run(scenario())
+    assert served == ["a", "c"]
+    assert sched.running == 0 and sched.waiting == 0
+
+
+def test_cancel_after_wakeup_frees_the_slot(app_module):
+    async def scenario():
+        sched = scheduler(app_module)
+        held = sched.slot("a", "reply")
+        await held.__aenter__()
+
+        async def turn():
+            async with sched.slot("b", "reply"):
+                pass
+
+        woken = asyncio.create_task(turn())
+        await settle()
+        # слот уже отдан «b», но задача отменена до того, как успела им воспользоваться
+        await held.__aexit__(None, None, None)
+        assert sched.running == 1 and sched.waiting == 0
+        woken.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await woken
+        return sched
+
+    sched = asyncio.run(scenario())
+    assert sched.running == 0 and sched.waiting == 0
+
+
+def test_full_queue_rejected(app_module):
+    async def scenario():
+        sched = scheduler(app_module, queue_max=1)
+        release = asyncio.Event()
+
+        async def turn(key, hold=None):
+            async with sched.slot(key, "reply"):
+                if hold:
+                    await hold.wait()
+
+        first = asyncio.create_task(turn("a", release))
+        await settle()
+        queued = asyncio.create_task(turn("b"))
+        await settle()
+        with pytest.raises(app_module.UpstreamBusy):
+            sched.admit("c")
+        with pytest.raises(app_module.UpstreamBusy):
+            async with sched.slot("c", "reply"):
+                pass
+        release.set()
+        await asyncio.gather(first, queued)
+
+    asyncio.run(scenario())
+
+
+def test_user_rate_limited(app_module):
+    sched = scheduler(app_module, user_rate=0.001, user_burst=2)
+    sched.admit(1)
+    sched.admit(1)
+    with pytest.raises(app_module.UpstreamBusy) as excinfo:
+        sched.admit(1)
+    assert excinfo.value.retry_after >= 1
+    sched.admit(2)
+
+
+def test_queue_wait_has_deadline(app_module):
+    async def scenario():
+        sched = app_module.LLMScheduler(1, 10, 100.0, 100.0, queue_timeout=0.05)
+        held = sched.slot("a", "reply")
+        await held.__aenter__()
+        with pytest.raises(app_module.UpstreamBusy):
+            async with sched.slot("b", "reply"):
+                pass
+        assert sched.waiting == 0 and not sched.queues
+        await held.__aexit__(None, None, None)
+        # после отказа очередь в порядке: следующий запрос сразу получает слот
+        async with sched.slot("b", "reply"):
+            assert sched.running == 1
+        return sched
+
+    sched = asyncio.run(scenario())
+    assert sched.running == 0
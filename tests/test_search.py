@@ -0,0 +1,33 @@
+import pytest
+
+
+@pytest.mark.parametrize("rank", [0.0, 0.1, 1 / 3, 1e-20])
+def test_search_cursor_round_trip_keeps_exact_rank(app_module, rank):
+    cursor = app_module.encode_search_cursor(rank, 123)
+    assert app_module.decode_search_cursor(cursor) == (rank, 123)
+
+
+@pytest.mark.parametrize("cursor", ["", "%%%", "MC41", "MC41fGFiYw==", "eHwx"])
+def test_invalid_search_cursor_rejected(app_module, cursor):
+    with pytest.raises(ValueError, match="Некорректный курсор"):
+        app_module.decode_search_cursor(cursor)
+
+
+def test_snippet_escaped_before_marks(app_module):
+    snippet = f"<b>{app_module.SNIPPET_START}кот{app_module.SNIPPET_STOP}</b>"
+    assert app_module.highlight_snippet(snippet) == "&lt;b&gt;<mark>кот</mark>&lt;/b&gt;"
+
+
+@pytest.fixture
+def client(app_module):
+    app_module.app.config["TESTING"] = True
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = 1
+    return client
+
+
+def test_search_reports_truncated_results(app_module, client, monkeypatch):
+    monkeypatch.setattr(app_module, "search_messages", lambda user_id, query, cursor, limit: ([], None, True))
+    data = client.get("/search?q=кот").get_json()
+    assert data == {"results": [], "next_cursor": None, "truncated": True}